@@ -21,7 +21,7 @@ import numpy as np
 import tensorflow as tf
 import cv2
 
-from helper import loader, tf_graph, utilty as util
+from helper import loader, resize, tf_graph, utilty as util
 
 BICUBIC_METHOD_STRING = "bicubic"
 
@@ -65,6 +65,33 @@ class SuperResolution(tf_graph.TensorflowGraph):
         else:
             self.stride_size = flags.stride_size
         self.patches_cnt = flags.patches_cnt
+        self.patch_memory_mb = flags.patch_memory_mb
+        self.patch_filter = flags.patch_filter
+        self.patch_filter_threshold = flags.patch_filter_threshold
+        self.flat_patch_keep = flags.flat_patch_keep
+        self.reuse_batch = flags.reuse_batch
+        self.batch_workers = flags.batch_workers
+        self.precompute_input = flags.precompute_input
+        self.prefetch_batches = flags.prefetch_batches
+        self.prefetcher = None
+        self.importance_sampling = flags.importance_sampling
+        self.importance_uniform_ratio = flags.importance_uniform_ratio
+        self.importance_sampler = None
+        self.tf_data_input = flags.tf_data_input
+        self.tf_data_workers = flags.tf_data_workers
+        self.in_graph_resize = flags.in_graph_resize
+        self.y_uint8 = None
+        self.image_cache_mb = flags.image_cache_mb
+        self.image_cache_dir = flags.image_cache_dir
+        self.patches_per_image = flags.patches_per_image
+        self.patch_atlas = flags.patch_atlas
+        self.random_crop_batch = flags.random_crop_batch
+        self.batch_augment_level = flags.batch_augment_level
+        self.sharded_batch = flags.sharded_batch
+        self.patch_shard_mb = flags.patch_shard_mb
+        self.shuffle_buffer_mb = flags.shuffle_buffer_mb
+        self.compressed_patches = flags.compressed_patches
+        self.compressed_cache_blocks = flags.compressed_cache_blocks
         self.clipping_norm = flags.clipping_norm
         self.use_l1_loss = flags.use_l1_loss
 
@@ -103,6 +130,12 @@ class SuperResolution(tf_graph.TensorflowGraph):
         # make input and output channels count same
         self.output_channels = 1
         self.psnr_calc_border_size = flags.psnr_calc_border_size
+        # host pre / post processing time of evaluated images
+        self.host_time_sum = 0.0
+        self.host_time_count = 0
+        self.eval_cache = None
+        if flags.eval_cache:
+            self.eval_cache = loader.EvalFixtureCache(flags.eval_cache_dir, max_bytes=flags.eval_cache_mb * 1024 * 1024)
         if self.psnr_calc_border_size < 0:
             self.psnr_calc_border_size = self.scale
 
@@ -151,9 +184,19 @@ class SuperResolution(tf_graph.TensorflowGraph):
         """
 
         self.train = loader.DynamicDataSets(self.scale, batch_image_size, channels=self.channels,
-                                            resampling_method=self.resampling_method)
+                                            resampling_method=self.resampling_method,
+                                            image_cache_mb=self.image_cache_mb, image_cache_dir=self.image_cache_dir,
+                                            patches_per_image=self.patches_per_image,
+                                            augment_level=self.batch_augment_level)
         self.train.set_data_dir(data_dir)
 
+        if self.in_graph_resize:
+            logging.warning("in_graph_resize needs build_batch. Resizing on host.")
+            self.in_graph_resize = False
+
+        if self.importance_sampling:
+            logging.warning("importance_sampling needs build_batch. Sampling uniformly.")
+
     def load_datasets(self, data_dir, batch_dir, batch_image_size, stride_size=0):
         """ build input patch images and loads as a datasets
         Opens image directory as a datasets.
@@ -163,34 +206,145 @@ class SuperResolution(tf_graph.TensorflowGraph):
         are limited by divided grids.
         """
 
-        batch_dir += "/scale%d" % self.scale
-        
-        self.train = loader.BatchDataSets(self.scale, batch_dir, batch_image_size, stride_size, channels=self.channels,
-                                          resampling_method=self.resampling_method, patches_cnt=self.patches_cnt, compress_input_q=self.compress_input_q)
-
-        self.train.build_batch(data_dir)
-        #if not self.train.is_batch_exist():
-        #    self.train.build_batch(data_dir)
-        #else:
-        #    self.train.load_batch_counts()
-        #self.train.load_all_batch_images()
+        # each kind of store is kept in its own directory, so switching between them doesn't rebuild the others
+        batch_dir += "/scale%d/" % self.scale
+
+        use_patch_store = not (self.patch_atlas or self.random_crop_batch or self.sharded_batch)
+        if not use_patch_store and self.compress_input_q > 1:
+            logging.warning("patch_atlas / random_crop_batch / sharded_batch don't support compress_input_q. "
+                            "Using patch store.")
+            use_patch_store = True
+        if not use_patch_store and (self.patch_memory_mb > 0 or self.patch_filter):
+            logging.warning("patch_memory_mb and patch_filter are only used by the patch store.")
+        if not use_patch_store and self.compressed_patches:
+            logging.warning("compressed_patches is only used by the patch store. Patches are not compressed.")
+
+        if use_patch_store and self.compressed_patches:
+            self.train = loader.CompressedBatchDataSets(self.scale, batch_dir + loader.CompressedBatchDataSets.STORE_TYPE,
+                                                        batch_image_size, stride_size,
+                                                        channels=self.channels,
+                                                        resampling_method=self.resampling_method,
+                                                        patches_cnt=self.patches_cnt,
+                                                        compress_input_q=self.compress_input_q,
+                                                        batch_workers=self.batch_workers,
+                                                        augment_level=self.batch_augment_level,
+                                                        patch_memory_mb=self.patch_memory_mb,
+                                                        patch_filter=self.patch_filter,
+                                                        patch_filter_threshold=self.patch_filter_threshold,
+                                                        flat_patch_keep=self.flat_patch_keep,
+                                                        cache_blocks=self.compressed_cache_blocks)
+        elif use_patch_store:
+            self.train = loader.BatchDataSets(self.scale, batch_dir + loader.BatchDataSets.STORE_TYPE,
+                                              batch_image_size, stride_size, channels=self.channels,
+                                              resampling_method=self.resampling_method, patches_cnt=self.patches_cnt, compress_input_q=self.compress_input_q,
+                                              batch_workers=self.batch_workers, augment_level=self.batch_augment_level,
+                                              patch_memory_mb=self.patch_memory_mb, patch_filter=self.patch_filter,
+                                              patch_filter_threshold=self.patch_filter_threshold,
+                                              flat_patch_keep=self.flat_patch_keep)
+        elif self.sharded_batch:
+            self.train = loader.ShardedBatchDataSets(self.scale, batch_dir + loader.ShardedBatchDataSets.STORE_TYPE,
+                                                     batch_image_size, stride_size,
+                                                     channels=self.channels, resampling_method=self.resampling_method,
+                                                     patches_cnt=self.patches_cnt,
+                                                     augment_level=self.batch_augment_level,
+                                                     shard_mb=self.patch_shard_mb,
+                                                     shuffle_buffer_mb=self.shuffle_buffer_mb)
+        elif self.random_crop_batch:
+            self.train = loader.RandomCropDataSets(self.scale, batch_dir + loader.RandomCropDataSets.STORE_TYPE,
+                                                   batch_image_size, stride_size,
+                                                   channels=self.channels, resampling_method=self.resampling_method,
+                                                   patches_cnt=self.patches_cnt,
+                                                   augment_level=self.batch_augment_level)
+        else:
+            self.train = loader.PatchAtlasDataSets(self.scale, batch_dir + loader.PatchAtlasDataSets.STORE_TYPE,
+                                                   batch_image_size, stride_size,
+                                                   channels=self.channels, resampling_method=self.resampling_method,
+                                                   patches_cnt=self.patches_cnt,
+                                                   augment_level=self.batch_augment_level)
+
+        if self.reuse_batch and self.train.is_batch_exist():
+            self.train.load_batch_counts()
+            self.train.load_all_batch_images()
+        else:
+            self.train.build_batch(data_dir)
+
+        if self.in_graph_resize and (self.compress_input_q > 1 or self.tf_data_input):
+            logging.warning("in_graph_resize doesn't support compress_input_q or tf_data_input. Resizing on host.")
+            self.in_graph_resize = False
+        if self.in_graph_resize and self.resampling_method not in resize.RESAMPLING_METHODS:
+            # resize matrices exist only for the methods of the numpy resize engine
+            logging.warning("in_graph_resize doesn't support resampling_method [%s]. Resizing on host." %
+                            self.resampling_method)
+            self.in_graph_resize = False
+
+        if self.precompute_input and self.in_graph_resize:
+            logging.info("precompute_input is skipped since input images are built in the graph.")
+        elif self.precompute_input and isinstance(self.train, loader.CompressedBatchDataSets):
+            # uncompressed input and bicubic images of all patches would take more memory than compression saves
+            logging.info("precompute_input is skipped since patches are compressed in memory.")
+        elif self.precompute_input:
+            self.train.build_input_batch_images()
+
+        if self.importance_sampling:
+            if self.train.RANDOM_PATCHES or self.tf_data_input:
+                logging.warning("importance_sampling needs fixed patches (not random_crop_batch / sharded_batch) "
+                                "and feed_dict input (not tf_data_input). Sampling uniformly.")
+            elif isinstance(self.train, loader.CompressedBatchDataSets):
+                # sampled patches are scattered over all blocks, so almost every patch would decompress a block
+                logging.warning("importance_sampling doesn't support compressed_patches. Sampling uniformly.")
+            else:
+                self.importance_sampler = loader.ImportanceSampler(self.train.count,
+                                                                   uniform_ratio=self.importance_uniform_ratio)
 
     def init_epoch_index(self):
 
-        self.batch_input = self.batch_num * [None]
-        self.batch_input_bicubic = self.batch_num * [None]
-        self.batch_true = self.batch_num * [None]
-
         self.training_psnr_sum = 0
         self.training_loss_sum = 0
         self.training_step = 0
+        self.train.log_stats()
+        if self.importance_sampler is not None:
+            # mini-batches depend on losses of the previous steps, so they are built in the training loop
+            self.importance_sampler.log_stats()
+            return
+
+        if self.prefetcher is not None:
+            # the prefetch thread owns the batch index and re-shuffles it by itself
+            self.prefetcher.log_stats()
+            return
+
         self.train.init_batch_index()
+        if self.prefetch_batches > 0 and not self.tf_data_input and not self.in_graph_resize:
+            self.prefetcher = loader.BatchPrefetcher(self.train, self.batch_num, self.max_value,
+                                                     prefetch_batches=self.prefetch_batches)
+            self.prefetcher.start()
 
     def build_input_batch(self):
 
-        for i in range(self.batch_num):
-            self.batch_input[i], self.batch_input_bicubic[i], self.batch_true[i] = self.train.load_batch_image(
-                self.max_value)
+        if self.tf_data_input:
+            # mini-batches come from the tf.data pipeline inside the graph
+            return
+
+        if self.in_graph_resize:
+            # only HR patches are fed. input and interpolated images are built in the graph
+            image_nos = None
+            if self.importance_sampler is not None:
+                self.batch_image_nos, self.batch_weights = self.importance_sampler.sample(self.batch_num)
+                image_nos = self.batch_image_nos
+            self.batch_true_uint8 = self.train.next_true_batch(self.batch_num, image_nos=image_nos)
+            return
+
+        if self.importance_sampler is not None:
+            self.batch_image_nos, self.batch_weights = self.importance_sampler.sample(self.batch_num)
+            self.batch_input, self.batch_input_bicubic, self.batch_true = self.train.next_batch(
+                self.batch_num, self.max_value, image_nos=self.batch_image_nos)
+            return
+
+        if self.prefetcher is not None:
+            self.batch_input, self.batch_input_bicubic, self.batch_true = self.prefetcher.get()
+            return
+
+        self.batch_input, self.batch_input_bicubic, self.batch_true = self.train.next_batch(self.batch_num,
+                                                                                             self.max_value)
 
     def load_graph(self, frozen_graph_filename='./model_to_freeze/frozen_model_optimized.pb'):
         """ 
@@ -225,11 +379,107 @@ class SuperResolution(tf_graph.TensorflowGraph):
         self.sess.close()
         super().init_session()
 
+    def build_input_tensors(self):
+        """
+        Build input tensors x, x2 and y. When tf_data_input is enabled they are placeholders with default values
+        from the training tf.data pipeline, so evaluate() / do() can still feed them as before.
+        """
+
+        if self.tf_data_input and self.train is not None:
+            x, x2, y = self.build_input_dataset()
+            self.x = tf.placeholder_with_default(x, shape=[None, None, None, self.channels], name="x")
+            self.y = tf.placeholder_with_default(y, shape=[None, None, None, self.output_channels], name="y")
+            self.x2 = tf.placeholder_with_default(x2, shape=[None, None, None, self.output_channels], name="x2")
+        elif self.in_graph_resize and self.train is not None:
+            x, x2, y = self.build_input_resize()
+            self.x = tf.placeholder_with_default(x, shape=[None, None, None, self.channels], name="x")
+            self.y = tf.placeholder_with_default(y, shape=[None, None, None, self.output_channels], name="y")
+            self.x2 = tf.placeholder_with_default(x2, shape=[None, None, None, self.output_channels], name="x2")
+        else:
+            self.x = tf.placeholder(tf.float32, shape=[None, None, None, self.channels], name="x")
+            self.y = tf.placeholder(tf.float32, shape=[None, None, None, self.output_channels], name="y")
+            self.x2 = tf.placeholder(tf.float32, shape=[None, None, None, self.output_channels], name="x2")
+
+    def build_input_dataset(self):
+        """
+        tf.data pipeline over training datasets: shuffle patch numbers, batch them and gather / downscale each
+        mini-batch with train.get_batch_images() in parallel map calls, then prefetch.
+        """
+
+        input_size = self.batch_image_size
+        true_size = self.batch_image_size * self.scale
+
+        def load_batch_images(image_nos):
+            return self.train.get_batch_images(image_nos, self.max_value)
+
+        with tf.name_scope("input_dataset"):
+            dataset = tf.data.Dataset.range(self.train.count)
+            dataset = dataset.shuffle(self.train.count, reshuffle_each_iteration=True).repeat()
+            dataset = dataset.batch(self.batch_num)
+            dataset = dataset.map(
+                lambda image_nos: tuple(tf.py_func(load_batch_images, [image_nos], [tf.float32, tf.float32, tf.float32],
+                                                   stateful=True)),
+                num_parallel_calls=max(self.tf_data_workers, 1))
+            dataset = dataset.prefetch(max(self.prefetch_batches, 1))
+            x, x2, y = dataset.make_one_shot_iterator().get_next()
+
+        x.set_shape([None, input_size, input_size, self.channels])
+        x2.set_shape([None, true_size, true_size, self.output_channels])
+        y.set_shape([None, true_size, true_size, self.output_channels])
+        logging.info("tf.data input pipeline: %d parallel calls, prefetch %d batches" % (
+            max(self.tf_data_workers, 1), max(self.prefetch_batches, 1)))
+        return x, x2, y
+
+    def build_input_resize(self):
+        """
+        Build x, x2 and y from uint8 HR patches fed to y_uint8: downscale to LR input and upscale it back with
+        resize matrices which match util.resize_image_by_pil(), instead of two PIL resizes per patch on host.
+        """
+
+        input_size = self.batch_image_size
+        true_size = self.batch_image_size * self.scale
+
+        down_matrix = resize.get_resize_matrix(true_size, input_size, self.resampling_method)
+        up_matrix = resize.get_resize_matrix(input_size, true_size, self.resampling_method)
+
+        self.y_uint8 = tf.placeholder(tf.uint8, shape=[None, true_size, true_size, self.output_channels],
+                                      name="y_uint8")
+        with tf.name_scope("input_resize"):
+            y = tf.cast(self.y_uint8, tf.float32)
+            x = util.resize_batch_by_matrix(y, down_matrix, down_matrix)
+            x2 = util.resize_batch_by_matrix(x, up_matrix, up_matrix)
+
+            if self.max_value != 255:
+                scale = self.max_value / 255.0
+                x, x2, y = x * scale, x2 * scale, y * scale
+
+        logging.info("In-graph resize: feeding uint8 [%d x %d] HR patches only" % (true_size, true_size))
+        return x, x2, y
+
+    def check_in_graph_resize(self):
+        """ log max abs difference (0-255) of in-graph x and x2 from util.resize_image_by_pil() of a mini-batch. """
+
+        true_batch = self.train.next_true_batch(self.batch_num, image_nos=np.arange(self.batch_num) % self.train.count)
+        x, x2 = self.sess.run([self.x, self.x2], feed_dict={self.y_uint8: true_batch})
+        scale = 255.0 / self.max_value
+
+        input_diff = interpolated_diff = 0.0
+        for i in range(true_batch.shape[0]):
+            input_image = util.resize_image_by_pil(true_batch[i], 1.0 / self.scale,
+                                                   resampling_method=self.resampling_method)
+            interpolated_image = util.resize_image_by_pil(input_image, self.scale,
+                                                          resampling_method=self.resampling_method)
+            input_diff = max(input_diff, np.max(np.abs(x[i] * scale - input_image)))
+            interpolated_diff = max(interpolated_diff, np.max(np.abs(x2[i] * scale - interpolated_image)))
+
+        logging.info("In-graph resize parity with PIL: max abs diff input %.2f, interpolated %.2f" % (
+            input_diff, interpolated_diff))
+        if input_diff > 1.0 or interpolated_diff > 2.0:
+            logging.warning("In-graph resize differs from PIL more than expected (input 1, interpolated 2).")
+
     def build_graph_dcscn(self):
 
-        self.x = tf.placeholder(tf.float32, shape=[None, None, None, self.channels], name="x")
-        self.y = tf.placeholder(tf.float32, shape=[None, None, None, self.output_channels], name="y")
-        self.x2 = tf.placeholder(tf.float32, shape=[None, None, None, self.output_channels], name="x2")
+        self.build_input_tensors()
         self.dropout = tf.placeholder(tf.float32, shape=[], name="dropout_keep_rate")
         self.is_training = tf.placeholder(tf.bool, name="is_training")
 
@@ -451,9 +701,7 @@ class SuperResolution(tf_graph.TensorflowGraph):
     '''                
     def build_graph_v1_edge_concat(self):
 
-        self.x = tf.placeholder(tf.float32, shape=[None, None, None, self.channels], name="x")
-        self.y = tf.placeholder(tf.float32, shape=[None, None, None, self.output_channels], name="y")
-        self.x2 = tf.placeholder(tf.float32, shape=[None, None, None, self.output_channels], name="x2")
+        self.build_input_tensors()
         self.dropout = tf.placeholder(tf.float32, shape=[], name="dropout_keep_rate")
         self.is_training = tf.placeholder(tf.bool, name="is_training")
 
@@ -551,9 +799,7 @@ class SuperResolution(tf_graph.TensorflowGraph):
     '''   
     def build_graph_v2_edge_concat(self):
 
-        self.x = tf.placeholder(tf.float32, shape=[None, None, None, self.channels], name="x")
-        self.y = tf.placeholder(tf.float32, shape=[None, None, None, self.output_channels], name="y")
-        self.x2 = tf.placeholder(tf.float32, shape=[None, None, None, self.output_channels], name="x2")
+        self.build_input_tensors()
         self.dropout = tf.placeholder(tf.float32, shape=[], name="dropout_keep_rate")
         self.is_training = tf.placeholder(tf.bool, name="is_training")
 
@@ -652,9 +898,7 @@ class SuperResolution(tf_graph.TensorflowGraph):
                 
                 
     def build_graph_v3_edge_concat(self):
-        self.x = tf.placeholder(tf.float32, shape=[None, None, None, self.channels], name="x")
-        self.y = tf.placeholder(tf.float32, shape=[None, None, None, self.output_channels], name="y")
-        self.x2 = tf.placeholder(tf.float32, shape=[None, None, None, self.output_channels], name="x2")
+        self.build_input_tensors()
         self.dropout = tf.placeholder(tf.float32, shape=[], name="dropout_keep_rate")
         self.is_training = tf.placeholder(tf.bool, name="is_training")
 
@@ -761,9 +1005,7 @@ class SuperResolution(tf_graph.TensorflowGraph):
                 util.add_summaries("output", self.name, self.y_, save_stddev=True, save_mean=True)	        
 
     def build_graph_v4_edge_concat(self):
-        self.x = tf.placeholder(tf.float32, shape=[None, None, None, self.channels], name="x")
-        self.y = tf.placeholder(tf.float32, shape=[None, None, None, self.output_channels], name="y")
-        self.x2 = tf.placeholder(tf.float32, shape=[None, None, None, self.output_channels], name="x2")
+        self.build_input_tensors()
         self.dropout = tf.placeholder(tf.float32, shape=[], name="dropout_keep_rate")
         self.is_training = tf.placeholder(tf.bool, name="is_training")
 
@@ -874,9 +1116,7 @@ class SuperResolution(tf_graph.TensorflowGraph):
     '''                
     def build_graph_v5_edge_concat(self):
 
-        self.x = tf.placeholder(tf.float32, shape=[None, None, None, self.channels], name="x")
-        self.y = tf.placeholder(tf.float32, shape=[None, None, None, self.output_channels], name="y")
-        self.x2 = tf.placeholder(tf.float32, shape=[None, None, None, self.output_channels], name="x2")
+        self.build_input_tensors()
         self.dropout = tf.placeholder(tf.float32, shape=[], name="dropout_keep_rate")
         self.is_training = tf.placeholder(tf.bool, name="is_training")
 
@@ -989,9 +1229,7 @@ class SuperResolution(tf_graph.TensorflowGraph):
                 
     def build_graph_v5_rzn_l(self):
 
-        self.x = tf.placeholder(tf.float32, shape=[None, None, None, self.channels], name="x")
-        self.y = tf.placeholder(tf.float32, shape=[None, None, None, self.output_channels], name="y")
-        self.x2 = tf.placeholder(tf.float32, shape=[None, None, None, self.output_channels], name="x2")
+        self.build_input_tensors()
         self.dropout = tf.placeholder(tf.float32, shape=[], name="dropout_keep_rate")
         self.is_training = tf.placeholder(tf.bool, name="is_training")
 
@@ -1072,9 +1310,7 @@ class SuperResolution(tf_graph.TensorflowGraph):
 
     def build_graph_v5_rzn_ul(self):
 
-        self.x = tf.placeholder(tf.float32, shape=[None, None, None, self.channels], name="x")
-        self.y = tf.placeholder(tf.float32, shape=[None, None, None, self.output_channels], name="y")
-        self.x2 = tf.placeholder(tf.float32, shape=[None, None, None, self.output_channels], name="x2")
+        self.build_input_tensors()
         self.dropout = tf.placeholder(tf.float32, shape=[], name="dropout_keep_rate")
         self.is_training = tf.placeholder(tf.bool, name="is_training")
 
@@ -1155,9 +1391,7 @@ class SuperResolution(tf_graph.TensorflowGraph):
                 
     def build_graph_v5_rzn(self):
 
-        self.x = tf.placeholder(tf.float32, shape=[None, None, None, self.channels], name="x")
-        self.y = tf.placeholder(tf.float32, shape=[None, None, None, self.output_channels], name="y")
-        self.x2 = tf.placeholder(tf.float32, shape=[None, None, None, self.output_channels], name="x2")
+        self.build_input_tensors()
         self.dropout = tf.placeholder(tf.float32, shape=[], name="dropout_keep_rate")
         self.is_training = tf.placeholder(tf.bool, name="is_training")
 
@@ -1257,9 +1491,7 @@ class SuperResolution(tf_graph.TensorflowGraph):
     '''
     def build_graph_v5_3_edge_concat(self):
 
-        self.x = tf.placeholder(tf.float32, shape=[None, None, None, self.channels], name="x")
-        self.y = tf.placeholder(tf.float32, shape=[None, None, None, self.output_channels], name="y")
-        self.x2 = tf.placeholder(tf.float32, shape=[None, None, None, self.output_channels], name="x2")
+        self.build_input_tensors()
         self.dropout = tf.placeholder(tf.float32, shape=[], name="dropout_keep_rate")
         self.is_training = tf.placeholder(tf.bool, name="is_training")
 
@@ -1411,9 +1643,7 @@ class SuperResolution(tf_graph.TensorflowGraph):
     '''
     def build_graph_v5_car(self):
 
-        self.x = tf.placeholder(tf.float32, shape=[None, None, None, self.channels], name="x")
-        self.y = tf.placeholder(tf.float32, shape=[None, None, None, self.output_channels], name="y")
-        self.x2 = tf.placeholder(tf.float32, shape=[None, None, None, self.output_channels], name="x2")
+        self.build_input_tensors()
         self.dropout = tf.placeholder(tf.float32, shape=[], name="dropout_keep_rate")
         self.is_training = tf.placeholder(tf.bool, name="is_training")
 
@@ -1550,9 +1780,7 @@ class SuperResolution(tf_graph.TensorflowGraph):
     '''
     def build_graph_v5_4_edge_concat(self):
 
-        self.x = tf.placeholder(tf.float32, shape=[None, None, None, self.channels], name="x")
-        self.y = tf.placeholder(tf.float32, shape=[None, None, None, self.output_channels], name="y")
-        self.x2 = tf.placeholder(tf.float32, shape=[None, None, None, self.output_channels], name="x2")
+        self.build_input_tensors()
         self.dropout = tf.placeholder(tf.float32, shape=[], name="dropout_keep_rate")
         self.is_training = tf.placeholder(tf.bool, name="is_training")
 
@@ -1691,9 +1919,7 @@ class SuperResolution(tf_graph.TensorflowGraph):
     # Similar to v3 and inspired from v5
     '''
     def build_graph_v6_edge_concat(self):
-        self.x = tf.placeholder(tf.float32, shape=[None, None, None, self.channels], name="x")
-        self.y = tf.placeholder(tf.float32, shape=[None, None, None, self.output_channels], name="y")
-        self.x2 = tf.placeholder(tf.float32, shape=[None, None, None, self.output_channels], name="x2")
+        self.build_input_tensors()
         self.dropout = tf.placeholder(tf.float32, shape=[], name="dropout_keep_rate")
         self.is_training = tf.placeholder(tf.bool, name="is_training")
 
@@ -1794,9 +2020,7 @@ class SuperResolution(tf_graph.TensorflowGraph):
     # similar to v6 but low complex than v6
     '''
     def build_graph_v6_1_edge_concat(self):
-        self.x = tf.placeholder(tf.float32, shape=[None, None, None, self.channels], name="x")
-        self.y = tf.placeholder(tf.float32, shape=[None, None, None, self.output_channels], name="y")
-        self.x2 = tf.placeholder(tf.float32, shape=[None, None, None, self.output_channels], name="x2")
+        self.build_input_tensors()
         self.dropout = tf.placeholder(tf.float32, shape=[], name="dropout_keep_rate")
         self.is_training = tf.placeholder(tf.bool, name="is_training")
 
@@ -1901,9 +2125,7 @@ class SuperResolution(tf_graph.TensorflowGraph):
     # similar to v6 but low complex than v6
     '''
     def build_graph_v6_2_edge_concat(self):
-        self.x = tf.placeholder(tf.float32, shape=[None, None, None, self.channels], name="x")
-        self.y = tf.placeholder(tf.float32, shape=[None, None, None, self.output_channels], name="y")
-        self.x2 = tf.placeholder(tf.float32, shape=[None, None, None, self.output_channels], name="x2")
+        self.build_input_tensors()
         self.dropout = tf.placeholder(tf.float32, shape=[], name="dropout_keep_rate")
         self.is_training = tf.placeholder(tf.bool, name="is_training")
 
@@ -2004,9 +2226,7 @@ class SuperResolution(tf_graph.TensorflowGraph):
     # similar to v6 but low complex than v6
     '''
     def build_graph_v6_3_edge_concat(self):
-        self.x = tf.placeholder(tf.float32, shape=[None, None, None, self.channels], name="x")
-        self.y = tf.placeholder(tf.float32, shape=[None, None, None, self.output_channels], name="y")
-        self.x2 = tf.placeholder(tf.float32, shape=[None, None, None, self.output_channels], name="x2")
+        self.build_input_tensors()
         self.dropout = tf.placeholder(tf.float32, shape=[], name="dropout_keep_rate")
         self.is_training = tf.placeholder(tf.bool, name="is_training")
 
@@ -2113,9 +2333,7 @@ class SuperResolution(tf_graph.TensorflowGraph):
     # Very light
     '''
     def build_graph_v7_edge_concat(self):
-        self.x = tf.placeholder(tf.float32, shape=[None, None, None, self.channels], name="x")
-        self.y = tf.placeholder(tf.float32, shape=[None, None, None, self.output_channels], name="y")
-        self.x2 = tf.placeholder(tf.float32, shape=[None, None, None, self.output_channels], name="x2")
+        self.build_input_tensors()
         self.dropout = tf.placeholder(tf.float32, shape=[], name="dropout_keep_rate")
         self.is_training = tf.placeholder(tf.bool, name="is_training")
 
@@ -2214,9 +2432,7 @@ class SuperResolution(tf_graph.TensorflowGraph):
     # Very light
     '''
     def build_graph_v7_1_edge_concat(self):
-        self.x = tf.placeholder(tf.float32, shape=[None, None, None, self.channels], name="x")
-        self.y = tf.placeholder(tf.float32, shape=[None, None, None, self.output_channels], name="y")
-        self.x2 = tf.placeholder(tf.float32, shape=[None, None, None, self.output_channels], name="x2")
+        self.build_input_tensors()
         self.dropout = tf.placeholder(tf.float32, shape=[], name="dropout_keep_rate")
         self.is_training = tf.placeholder(tf.bool, name="is_training")
 
@@ -2321,9 +2537,7 @@ class SuperResolution(tf_graph.TensorflowGraph):
     # Very light
     '''
     def build_graph_v8_edge_concat(self):
-        self.x = tf.placeholder(tf.float32, shape=[None, None, None, self.channels], name="x")
-        self.y = tf.placeholder(tf.float32, shape=[None, None, None, self.output_channels], name="y")
-        self.x2 = tf.placeholder(tf.float32, shape=[None, None, None, self.output_channels], name="x2")
+        self.build_input_tensors()
         self.dropout = tf.placeholder(tf.float32, shape=[], name="dropout_keep_rate")
         self.is_training = tf.placeholder(tf.bool, name="is_training")
 
@@ -2404,9 +2618,7 @@ class SuperResolution(tf_graph.TensorflowGraph):
     # Very light
     '''
     def build_graph_v8_1_edge_concat(self):
-        self.x = tf.placeholder(tf.float32, shape=[None, None, None, self.channels], name="x")
-        self.y = tf.placeholder(tf.float32, shape=[None, None, None, self.output_channels], name="y")
-        self.x2 = tf.placeholder(tf.float32, shape=[None, None, None, self.output_channels], name="x2")
+        self.build_input_tensors()
         self.dropout = tf.placeholder(tf.float32, shape=[], name="dropout_keep_rate")
         self.is_training = tf.placeholder(tf.bool, name="is_training")
 
@@ -2493,9 +2705,7 @@ class SuperResolution(tf_graph.TensorflowGraph):
     # Very light
     '''
     def build_graph_v9_edge_concat(self):
-        self.x = tf.placeholder(tf.float32, shape=[None, None, None, self.channels], name="x")
-        self.y = tf.placeholder(tf.float32, shape=[None, None, None, self.output_channels], name="y")
-        self.x2 = tf.placeholder(tf.float32, shape=[None, None, None, self.output_channels], name="x2")
+        self.build_input_tensors()
         self.dropout = tf.placeholder(tf.float32, shape=[], name="dropout_keep_rate")
         self.is_training = tf.placeholder(tf.bool, name="is_training")
 
@@ -2584,9 +2794,7 @@ class SuperResolution(tf_graph.TensorflowGraph):
     # Very light
     '''
     def build_graph_v9_1_edge_concat(self):
-        self.x = tf.placeholder(tf.float32, shape=[None, None, None, self.channels], name="x")
-        self.y = tf.placeholder(tf.float32, shape=[None, None, None, self.output_channels], name="y")
-        self.x2 = tf.placeholder(tf.float32, shape=[None, None, None, self.output_channels], name="x2")
+        self.build_input_tensors()
         self.dropout = tf.placeholder(tf.float32, shape=[], name="dropout_keep_rate")
         self.is_training = tf.placeholder(tf.bool, name="is_training")
 
@@ -2689,9 +2897,7 @@ class SuperResolution(tf_graph.TensorflowGraph):
     # Arch suggested by Nitchith
     '''
     def build_graph_v33_edge_concat(self):
-        self.x = tf.placeholder(tf.float32, shape=[None, None, None, self.channels], name="x")
-        self.y = tf.placeholder(tf.float32, shape=[None, None, None, self.output_channels], name="y")
-        self.x2 = tf.placeholder(tf.float32, shape=[None, None, None, self.output_channels], name="x2")
+        self.build_input_tensors()
         self.dropout = tf.placeholder(tf.float32, shape=[], name="dropout_keep_rate")
         self.is_training = tf.placeholder(tf.bool, name="is_training")
 
@@ -2753,9 +2959,7 @@ class SuperResolution(tf_graph.TensorflowGraph):
         
     # Complex model
     def build_graph_v20_edge_concat(self):
-        self.x = tf.placeholder(tf.float32, shape=[None, None, None, self.channels], name="x")
-        self.y = tf.placeholder(tf.float32, shape=[None, None, None, self.output_channels], name="y")
-        self.x2 = tf.placeholder(tf.float32, shape=[None, None, None, self.output_channels], name="x2")
+        self.build_input_tensors()
         self.dropout = tf.placeholder(tf.float32, shape=[], name="dropout_keep_rate")
         self.is_training = tf.placeholder(tf.bool, name="is_training")
 
@@ -2925,7 +3129,17 @@ class SuperResolution(tf_graph.TensorflowGraph):
 
         diff = tf.subtract(self.y_, self.y, "diff")
 
-        if self.use_l1_loss:
+        if self.importance_sampler is not None:
+            # per-patch loss weighted by importance weights (1 / (N p)) of the sampled patches
+            self.mse = tf.reduce_mean(tf.square(diff, name="diff_square"), name="mse")
+            if self.use_l1_loss:
+                self.sample_loss = tf.reduce_mean(tf.abs(diff, name="diff_abs"), axis=[1, 2, 3], name="sample_loss")
+            else:
+                self.sample_loss = tf.reduce_mean(tf.square(diff), axis=[1, 2, 3], name="sample_loss")
+            self.sample_weights = tf.placeholder_with_default(tf.ones_like(self.sample_loss), shape=[None],
+                                                              name="sample_weights")
+            self.image_loss = tf.reduce_mean(self.sample_weights * self.sample_loss, name="image_loss")
+        elif self.use_l1_loss:
             self.mse = tf.reduce_mean(tf.square(diff, name="diff_square"), name="mse")
             self.image_loss = tf.reduce_mean(tf.abs(diff, name="diff_abs"), name="image_loss")
         else:
@@ -3000,10 +3214,23 @@ class SuperResolution(tf_graph.TensorflowGraph):
 
     def train_batch(self):
 
-        feed_dict = {self.x: self.batch_input, self.x2: self.batch_input_bicubic, self.y: self.batch_true,
-                     self.lr_input: self.lr, self.dropout: self.dropout_rate, self.is_training: 1}
-
-        _, image_loss, mse = self.sess.run([self.training_optimizer, self.image_loss, self.mse], feed_dict=feed_dict)
+        if self.tf_data_input:
+            feed_dict = {self.lr_input: self.lr, self.dropout: self.dropout_rate, self.is_training: 1}
+        elif self.in_graph_resize:
+            feed_dict = {self.y_uint8: self.batch_true_uint8, self.lr_input: self.lr, self.dropout: self.dropout_rate,
+                         self.is_training: 1}
+        else:
+            feed_dict = {self.x: self.batch_input, self.x2: self.batch_input_bicubic, self.y: self.batch_true,
+                         self.lr_input: self.lr, self.dropout: self.dropout_rate, self.is_training: 1}
+
+        if self.importance_sampler is not None:
+            feed_dict[self.sample_weights] = self.batch_weights
+            _, image_loss, mse, sample_loss = self.sess.run(
+                [self.training_optimizer, self.image_loss, self.mse, self.sample_loss], feed_dict=feed_dict)
+            self.importance_sampler.update(self.batch_image_nos, sample_loss)
+        else:
+            _, image_loss, mse = self.sess.run([self.training_optimizer, self.image_loss, self.mse],
+                                               feed_dict=feed_dict)
         self.training_loss_sum += image_loss
         self.training_psnr_sum += util.get_psnr(mse, max_value=self.max_value)
 
@@ -3220,25 +3447,55 @@ class SuperResolution(tf_graph.TensorflowGraph):
         output_folder += "/" + self.name + "/"
         util.save_image(output_folder + filename + extension, org_image)
 
-        scaled_image = util.resize_image_by_pil(org_image, self.scale, resampling_method=self.resampling_method)
-        util.save_image(output_folder + filename + "_bicubic" + extension, scaled_image)
+        sr_image = loader.SRImage(org_image, self.scale, channels=self.channels,
+                                  resampling_method=self.resampling_method, downscale=False)
+        util.save_image(output_folder + filename + "_bicubic" + extension, sr_image.bicubic_rgb)
+        util.save_image(output_folder + filename + "_bicubic_y" + extension, sr_image.bicubic_y)
 
-        if len(org_image.shape) >= 3 and org_image.shape[2] == 3 and self.channels == 1:
-            input_y_image = util.convert_rgb_to_y(org_image)
-            scaled_image = util.resize_image_by_pil(input_y_image, self.scale, resampling_method=self.resampling_method)
-            util.save_image(output_folder + filename + "_bicubic_y" + extension, scaled_image)
-            output_y_image = self.do(input_y_image)
+        if sr_image.is_color:
+            output_y_image = self.do(sr_image.input_y, sr_image.bicubic_y)
             util.save_image(output_folder + filename + "_result_y" + extension, output_y_image)
-
-            scaled_ycbcr_image = util.convert_rgb_to_ycbcr(
-                util.resize_image_by_pil(org_image, self.scale, self.resampling_method))
-            image = util.convert_y_and_cbcr_to_rgb(output_y_image, scaled_ycbcr_image[:, :, 1:3])
+            image = sr_image.to_rgb(output_y_image)
         else:
-            scaled_image = util.resize_image_by_pil(org_image, self.scale, resampling_method=self.resampling_method)
-            util.save_image(output_folder + filename + "_bicubic_y" + extension, scaled_image)
-            image = self.do(org_image)
+            image = self.do(sr_image.input_y, sr_image.bicubic_y)
 
         util.save_image(output_folder + filename + "_result" + extension, image)
+        self.add_host_time(sr_image)
+
+    def load_sr_image(self, file_path):
+        """
+        returns (aligned true image, SRImage) of file_path, or (None, None) if the image is not supported.
+        SRImages are taken from the evaluation fixture cache when eval_cache is enabled.
+        """
+
+        def build_sr_image(filename):
+            true_image = util.set_image_alignment(util.load_image(filename, print_console=False), self.scale)
+            if self.channels != 1 or true_image.shape[2] not in (1, 3):
+                return None
+            return loader.SRImage(true_image, self.scale, channels=self.channels,
+                                  resampling_method=self.resampling_method, compress_input_q=self.compress_input_q)
+
+        if self.eval_cache is not None:
+            key = "x%d_q%d_%s" % (self.scale, self.compress_input_q, self.resampling_method)
+            sr_image = self.eval_cache.get(file_path, key, build_sr_image)
+        else:
+            sr_image = build_sr_image(file_path)
+
+        if sr_image is None:
+            return None, None
+        return sr_image.true_image, sr_image
+
+    def add_host_time(self, sr_image):
+        self.host_time_sum += sr_image.host_time
+        self.host_time_count += 1
+
+    def reset_host_time(self):
+        self.host_time_sum = 0.0
+        self.host_time_count = 0
+
+    def get_host_time(self):
+        """ returns average host pre / post processing time per image (sec) since reset_host_time(). """
+        return self.host_time_sum / self.host_time_count if self.host_time_count > 0 else 0.0
 
     def do_for_evaluate_with_output(self, file_path, output_directory, print_console=False):
 
@@ -3246,82 +3503,30 @@ class SuperResolution(tf_graph.TensorflowGraph):
         output_directory += "/" + self.name + "/"
         util.make_dir(output_directory)
 
-        true_image = util.set_image_alignment(util.load_image(file_path, print_console=False), self.scale)
-        input_image = util.resize_image_by_pil(true_image, 1.0/ self.scale, resampling_method=self.resampling_method)
-        input_bicubic_image = util.resize_image_by_pil(input_image, self.scale, resampling_method=self.resampling_method)
-        # RGB-HR (bicubic): down-scaled and up-scaled image
-        #util.save_image(output_directory + filename + "_input_bicubic" + extension, input_bicubic_image)
+        true_image, sr_image = self.load_sr_image(file_path)
+        if sr_image is None:
+            return None, None, None, None
 
-        psnr = ssim = psnr_rgb = ssim_rgb = 0
-        if true_image.shape[2] == 3 and self.channels == 1:
+        # Network inference
+        output_y_image = self.do(sr_image.input_y, sr_image.bicubic_y)
 
-            true_ycbcr_image = util.convert_rgb_to_ycbcr(true_image)        
-            
-            if self.compress_input_q > 1:
-                input_y_image, u_lr, v_lr = util.compress_with_jpeg(true_image, self.compress_input_q, self.scale, self.resampling_method)
-                # bicubic upscale YUV channels (Y for network input, UV for final output)
-            else:
-                # for color images
-                input_y_image = loader.build_input_image(true_image, channels=self.channels, scale=self.scale,
-                                                        alignment=self.scale, convert_ycbcr=True)
-    
-                # create u,v LR images from HR u,v
-                u_lr = util.resize_image_by_pil(true_ycbcr_image[:,:,1:2], 1.0/ self.scale, resampling_method=self.resampling_method)
-                v_lr = util.resize_image_by_pil(true_ycbcr_image[:,:,2:3], 1.0/ self.scale, resampling_method=self.resampling_method)
-                
-            # bicubic up-scale y channels
-            input_bicubic_y_image = util.resize_image_by_pil(input_y_image, self.scale, resampling_method=self.resampling_method)                
-            # bicubic up-scale u, v channels
-            u_hr = util.resize_image_by_pil(u_lr, self.scale, resampling_method=self.resampling_method)
-            v_hr = util.resize_image_by_pil(v_lr, self.scale, resampling_method=self.resampling_method)
-
-            # Network inference
-            output_y_image = self.do(input_y_image, input_bicubic_y_image)
-            
-            # compute Y PSNR, SSIM
-            psnr, ssim = util.compute_psnr_and_ssim(true_ycbcr_image[:, :, 0:1], output_y_image,
-                                                    border_size=self.psnr_calc_border_size)
-            # get loss image
-            #loss_image = util.get_loss_image(true_ycbcr_image[:, :, 0:1], output_y_image,
-            #                                 border_size=self.psnr_calc_border_size)
-
-            #output_color_image = util.convert_y_and_cbcr_to_rgb(output_y_image, true_ycbcr_image[:, :, 1:3])
+        # compute Y PSNR, SSIM
+        psnr, ssim = util.compute_psnr_and_ssim(sr_image.true_y, output_y_image, border_size=self.psnr_calc_border_size)
+        psnr_rgb = ssim_rgb = 0
+
+        if sr_image.is_color:
             # create color image from model upscaling (Y) and bicubic (uv)
-            uv_image = np.zeros([u_hr.shape[0], u_hr.shape[1], 2])
-            uv_image[:, :, 0] = u_hr[:, :, 0]
-            uv_image[:, :, 1] = v_hr[:, :, 0]
-            output_color_image = util.convert_y_and_cbcr_to_rgb(output_y_image, uv_image)
-            
+            output_color_image = sr_image.to_rgb(output_y_image)
+
             # compute RGB PSNR, SSIM
             psnr_rgb, ssim_rgb = util.compute_psnr_and_ssim(true_image, output_color_image,
-                                                    border_size=self.psnr_calc_border_size)            
-
-            #util.save_image(output_directory + file_path, true_image)
-            # Y-LR: input to model, rgb2yuv converted and downscaled
-            #util.save_image(output_directory + filename + "_input" + extension, input_y_image)
-            # Y-HR (bicubic): downscaled and upscaled with bicubic
-            #util.save_image(output_directory + filename + "_input_bicubic_y" + extension, input_bicubic_y_image)
-            # Y-HR: Actual input
-            #util.save_image(output_directory + filename + "_true_y" + extension, true_ycbcr_image[:, :, 0:1])
-            # Y-HR: Model output
-            #util.save_image(output_directory + filename + "_result" + extension, output_y_image)
+                                                            border_size=self.psnr_calc_border_size)
             util.save_image(output_directory + filename + "_result_c" + extension, output_color_image)
-            #util.save_image(output_directory + filename + "_loss" + extension, loss_image)
-
-        elif true_image.shape[2] == 1 and self.channels == 1:
-
-            # for monochrome images
-            if self.compress_input_q > 1:
-                input_image, u_lr, v_lr = util.compress_with_jpeg(true_image, self.compress_input_q, self.scale, self.resampling_method)
-            else:
-                input_image = loader.build_input_image(true_image, channels=self.channels, scale=self.scale, alignment=self.scale)
-            input_bicubic_y_image = util.resize_image_by_pil(input_image, self.scale, resampling_method=self.resampling_method)
-            output_image = self.do(input_image, input_bicubic_y_image)
-            psnr, ssim = util.compute_psnr_and_ssim(true_image, output_image, border_size=self.psnr_calc_border_size)
-            util.save_image(output_directory + file_path, true_image)
-            util.save_image(output_directory + filename + "_result" + extension, output_image)
         else:
-            return None, None, None, None
+            util.save_image(output_directory + file_path, true_image)
+            util.save_image(output_directory + filename + "_result" + extension, output_y_image)
+
+        self.add_host_time(sr_image)
 
         if print_console:
             logging.info("[%s] PSNR_Y  :%f, SSIM_Y  :%f" % (filename, psnr, ssim))
@@ -3331,57 +3536,25 @@ class SuperResolution(tf_graph.TensorflowGraph):
 
     def do_for_evaluate(self, file_path, print_console=False):
 
-        true_image = util.set_image_alignment(util.load_image(file_path, print_console=False), self.scale)
+        true_image, sr_image = self.load_sr_image(file_path)
+        if sr_image is None:
+            return None, None, None, None
 
-        psnr = ssim = psnr_rgb = ssim_rgb = 0
-        if true_image.shape[2] == 3 and self.channels == 1:
+        # Network inference
+        output_y_image = self.do(sr_image.input_y, sr_image.bicubic_y)
 
-            true_ycbcr_image = util.convert_rgb_to_ycbcr(true_image)                                                    
-            
-            if self.compress_input_q > 1:     
-                input_y_image, u_lr, v_lr = util.compress_with_jpeg(true_image, self.compress_input_q, self.scale, self.resampling_method)
-            else:
-                # for color images
-                input_y_image = loader.build_input_image(true_image, channels=self.channels, scale=self.scale,
-                                                        alignment=self.scale, convert_ycbcr=True)
-                # down-scale u,v channels
-                u_lr = util.resize_image_by_pil(true_ycbcr_image[:,:,1:2], 1.0/ self.scale, resampling_method=self.resampling_method)
-                v_lr = util.resize_image_by_pil(true_ycbcr_image[:,:,2:3], 1.0/ self.scale, resampling_method=self.resampling_method)
-                                                        
-            true_y_image = util.convert_rgb_to_y(true_image)
-            # bicubic up-scale y channels
-            input_bicubic_y_image = util.resize_image_by_pil(input_y_image, self.scale, resampling_method=self.resampling_method)
-            # bicubic up-scale u, v channels
-            u_hr = util.resize_image_by_pil(u_lr, self.scale, resampling_method=self.resampling_method)
-            v_hr = util.resize_image_by_pil(v_lr, self.scale, resampling_method=self.resampling_method)
-            
-            # Network inference
-            output_y_image = self.do(input_y_image, input_bicubic_y_image)
-            
-            # compute Y PSNR, SSIM
-            psnr, ssim = util.compute_psnr_and_ssim(true_y_image, output_y_image, border_size=self.psnr_calc_border_size)
-            
+        # compute Y PSNR, SSIM
+        psnr, ssim = util.compute_psnr_and_ssim(sr_image.true_y, output_y_image, border_size=self.psnr_calc_border_size)
+        psnr_rgb = ssim_rgb = 0
+
+        if sr_image.is_color:
             # create color image from model upscaling (Y) and bicubic (uv)
-            uv_image = np.zeros([u_hr.shape[0], u_hr.shape[1], 2])
-            uv_image[:, :, 0] = u_hr[:, :, 0]
-            uv_image[:, :, 1] = v_hr[:, :, 0]
-            output_color_image = util.convert_y_and_cbcr_to_rgb(output_y_image, uv_image)
+            output_color_image = sr_image.to_rgb(output_y_image)
             # compute RGB PSNR, SSIM
             psnr_rgb, ssim_rgb = util.compute_psnr_and_ssim(true_image, output_color_image,
-                                                    border_size=self.psnr_calc_border_size)            
-                                                    
-        elif true_image.shape[2] == 1 and self.channels == 1:
-
-            # for monochrome images
-            if self.compress_input_q > 1:
-                input_image, u_lr, v_lr = util.compress_with_jpeg(true_image, self.compress_input_q, self.scale, self.resampling_method)
-            else:            
-                input_image = loader.build_input_image(true_image, channels=self.channels, scale=self.scale, alignment=self.scale)
-            input_bicubic_y_image = util.resize_image_by_pil(input_image, self.scale, resampling_method=self.resampling_method)
-            output_image = self.do(input_image, input_bicubic_y_image)
-            psnr, ssim = util.compute_psnr_and_ssim(true_image, output_image, border_size=self.psnr_calc_border_size)
-        else:
-            return None, None, None, None
+                                                            border_size=self.psnr_calc_border_size)
+
+        self.add_host_time(sr_image)
 
         if print_console:
             logging.info("[%s] PSNR_Y  :%f, SSIM_Y  :%f" % (file_path, psnr, ssim))
@@ -3391,49 +3564,24 @@ class SuperResolution(tf_graph.TensorflowGraph):
 
     def evaluate_bicubic(self, file_path, print_console=False):
 
-        psnr = ssim = psnr_rgb = ssim_rgb = 0
-        true_image = util.set_image_alignment(util.load_image(file_path, print_console=False), self.scale)
-
-        if true_image.shape[2] == 3 and self.channels == 1:
-            if self.compress_input_q > 1:
-                # compress input image
-                input_y_image, u_lr, v_lr = util.compress_with_jpeg(true_image, self.compress_input_q, self.scale, self.resampling_method)
-                input_image = input_y_image
-            else:
-                input_image_yuv = loader.build_input_image(true_image, channels=self.channels, scale=self.scale,
-                                                    alignment=self.scale, convert_ycbcr=True)
-                input_image = input_image_yuv[:,:,0:1]
-                u_lr = input_image_yuv[:,:,1:2]
-                v_lr = input_image_yuv[:,:,2:3]
-                
-            true_image_y = util.convert_rgb_to_y(true_image)
-        elif true_image.shape[2] == 1 and self.channels == 1:
-            # for monochrome images
-            if self.compress_input_q > 1:
-                input_image, u_lr, v_lr = util.compress_with_jpeg(true_image, self.compress_input_q, self.scale, self.resampling_method)
-            else:            
-                input_image = loader.build_input_image(true_image, channels=self.channels, scale=self.scale, alignment=self.scale)
-            true_image_y = true_image
-        else:
+        # RGB result is computed only for compressed inputs, so bicubic CbCr isn't built here otherwise
+        true_image, sr_image = self.load_sr_image(file_path)
+        if sr_image is None:
             return None, None, None, None
 
-        input_bicubic_image = util.resize_image_by_pil(input_image, self.scale, resampling_method=self.resampling_method)
-        psnr, ssim = util.compute_psnr_and_ssim(true_image_y, input_bicubic_image, border_size=self.psnr_calc_border_size)
+        psnr, ssim = util.compute_psnr_and_ssim(sr_image.true_y, sr_image.bicubic_y,
+                                                border_size=self.psnr_calc_border_size)
+        psnr_rgb = ssim_rgb = 0
 
-        #print("true_image.shape:{}, input_image_yuv.shape: {}, u_lr.shape: {}, input_image.shape: {}, file_path: {}".format(true_image.shape, input_image_yuv.shape, u_lr.shape, input_image.shape, file_path))
-        if self.compress_input_q > 1 and true_image.shape[2] == 3 and self.channels == 1:
-            # bicubic up-scale u, v channels
-            u_hr = util.resize_image_by_pil(u_lr, self.scale, resampling_method=self.resampling_method)
-            v_hr = util.resize_image_by_pil(v_lr, self.scale, resampling_method=self.resampling_method)        
-            # create color image from model upscaling (Y) and bicubic (uv)
-            uv_image = np.zeros([u_hr.shape[0], u_hr.shape[1], 2])
-            uv_image[:, :, 0] = u_hr[:, :, 0]
-            uv_image[:, :, 1] = v_hr[:, :, 0]
-            output_color_image = util.convert_y_and_cbcr_to_rgb(input_bicubic_image, uv_image)
+        if self.compress_input_q > 1 and sr_image.is_color:
+            # create color image from bicubic (Y) and bicubic (uv)
+            output_color_image = sr_image.to_rgb(sr_image.bicubic_y)
             # compute RGB PSNR, SSIM
             psnr_rgb, ssim_rgb = util.compute_psnr_and_ssim(true_image, output_color_image,
-                                                    border_size=self.psnr_calc_border_size)                        
-            
+                                                            border_size=self.psnr_calc_border_size)
+
+        self.add_host_time(sr_image)
+
         if print_console:
             logging.info("PSNR:%f, SSIM:%f" % (psnr, ssim))
 
@@ -3449,11 +3597,26 @@ class SuperResolution(tf_graph.TensorflowGraph):
         self.min_validation_epoch = -1
         self.step = 0
 
+        if self.importance_sampler is not None:
+            # losses of the previous trial's model don't apply to the re-initialized model
+            self.importance_sampler.reset()
+
+        if self.in_graph_resize and self.y_uint8 is not None:
+            self.check_in_graph_resize()
+
         self.start_time = time.time()
 
     def end_train_step(self):
         self.total_time = time.time() - self.start_time
 
+        if self.prefetcher is not None:
+            self.prefetcher.log_stats()
+            self.prefetcher.stop()
+            self.prefetcher = None
+
+        if self.eval_cache is not None:
+            self.eval_cache.log_stats()
+
     def print_steps_completed(self, output_to_logging=False):
 
         if self.step == 0:
@@ -8,19 +8,46 @@ Create Augmented training images
 Put your images under data/[your dataset name]/ and specify [your dataset name] for --dataset.
 
 --augment_level 2-8: will generate flipped / rotated images
+--augment_output shards: (default) Y planes of augmented images are packed into .npy shards with an index.
+                         build_batch reads them without decoding any image. (only for channels=1)
+--augment_output images: augmented images are saved as image files like before.
 
+Files are processed by a pool of --augment_workers processes.
 """
+import collections
+import multiprocessing
 import os
 
-import numpy as np
 import tensorflow as tf
 
-from helper import args, utilty as util
+from helper import args, loader, utilty as util
 
 args.flags.DEFINE_integer("augment_level", 4, "Augmentation level. 4:+LR/UD/LR-UD flipped, 7:+rotated")
+args.flags.DEFINE_string("augment_output", "shards", "[shards, images] Pack Y planes into .npy shards or save image files")
+args.flags.DEFINE_integer("augment_workers", 0, "Number of worker processes. 0 uses all CPUs.")
+args.flags.DEFINE_integer("shard_mb", 256, "Size of each .npy shard (MB) for --augment_output shards")
 
 FLAGS = args.get()
 
+# file name suffix of each util.flip() type
+FLIP_SUFFIXES = ["", "_v", "_h", "_hv", "_r1", "_r2", "_r1_v", "_r2_v"]
+
+
+def save_augmented_images(worker_args):
+    """ decode one image and save its augmented images as image files. """
+
+    file_path, target_dir, augment_level = worker_args
+    org_image = util.load_image(file_path, print_console=False)
+
+    filename, extension = os.path.splitext(os.path.basename(file_path))
+    for flip_type in range(augment_level):
+        util.save_image(target_dir + filename + FLIP_SUFFIXES[flip_type] + extension, util.flip(org_image, flip_type))
+
+
+def load_named_y_plane(file_path):
+    """ decode one image and returns (file name, uint8 Y plane). augmented planes are flipped from this in parent. """
+    return os.path.basename(file_path), loader.load_y_plane(file_path)
+
 
 def main(not_parsed_args):
     if len(not_parsed_args) > 1:
@@ -33,41 +60,34 @@ def main(not_parsed_args):
     target_dir = FLAGS.data_dir + "/" + FLAGS.dataset + ("_%d/" % FLAGS.augment_level)
     util.make_dir(target_dir)
 
-    for file_path in training_filenames:
-        org_image = util.load_image(file_path)
-
-        filename = os.path.basename(file_path)
-        filename, extension = os.path.splitext(filename)
-
-        new_filename = target_dir + filename
-        util.save_image(new_filename + extension, org_image)
-
-        if FLAGS.augment_level >= 2:
-            ud_image = np.flipud(org_image)
-            util.save_image(new_filename + "_v" + extension, ud_image)
-        if FLAGS.augment_level >= 3:
-            lr_image = np.fliplr(org_image)
-            util.save_image(new_filename + "_h" + extension, lr_image)
-        if FLAGS.augment_level >= 4:
-            lr_image = np.fliplr(org_image)
-            lrud_image = np.flipud(lr_image)
-            util.save_image(new_filename + "_hv" + extension, lrud_image)
-
-        if FLAGS.augment_level >= 5:
-            rotated_image1 = np.rot90(org_image)
-            util.save_image(new_filename + "_r1" + extension, rotated_image1)
-        if FLAGS.augment_level >= 6:
-            rotated_image2 = np.rot90(org_image, -1)
-            util.save_image(new_filename + "_r2" + extension, rotated_image2)
-
-        if FLAGS.augment_level >= 7:
-            rotated_image1 = np.rot90(org_image)
-            ud_image = np.flipud(rotated_image1)
-            util.save_image(new_filename + "_r1_v" + extension, ud_image)
-        if FLAGS.augment_level >= 8:
-            rotated_image2 = np.rot90(org_image, -1)
-            ud_image = np.flipud(rotated_image2)
-            util.save_image(new_filename + "_r2_v" + extension, ud_image)
+    augment_level = max(1, min(FLAGS.augment_level, len(FLIP_SUFFIXES)))
+    workers = FLAGS.augment_workers if FLAGS.augment_workers > 0 else multiprocessing.cpu_count()
+
+    with multiprocessing.Pool(workers) as pool:
+        if FLAGS.augment_output == "images":
+            worker_args = [(file_path, target_dir, augment_level) for file_path in training_filenames]
+            for _ in pool.imap_unordered(save_augmented_images, worker_args):
+                pass
+        else:
+            # stream decoded Y planes in file order and write their flipped views straight into shards.
+            # at most max_pending images are decoded ahead, so decoding can't outrun shard writing unbounded.
+            writer = loader.ShardWriter(target_dir, shard_bytes=FLAGS.shard_mb * 1024 * 1024)
+            max_pending = workers * 2
+            pending = collections.deque()
+            file_paths = iter(training_filenames)
+            while True:
+                for file_path in file_paths:
+                    pending.append(pool.apply_async(load_named_y_plane, (file_path,)))
+                    if len(pending) >= max_pending:
+                        break
+                if not pending:
+                    break
+
+                basename, y_image = pending.popleft().get()
+                filename, extension = os.path.splitext(basename)
+                for flip_type in range(augment_level):
+                    writer.add(filename + FLIP_SUFFIXES[flip_type] + extension, util.flip(y_image, flip_type))
+            writer.close()
 
 
 if __name__ == '__main__':
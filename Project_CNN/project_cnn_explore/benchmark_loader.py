@@ -0,0 +1,89 @@
+"""
+Paper: "Fast and Accurate Image Super Resolution by Deep CNN with Skip Connection and Network in Network"
+Author: Jin Yamanaka
+Github: https://github.com/jiny2001/dcscn-image-super-resolution
+
+Benchmark training data loaders
+
+Measures patches/sec of next_batch() for grid patch store (BatchDataSets), the same store compressed in memory
+(CompressedBatchDataSets, also logs its memory saving and decompression time per mini-batch), random offset crops
+(RandomCropDataSets) and dynamic loading from image files (DynamicDataSets) on --dataset.
+Patch store and atlas are built into their own subdirectories of --batch_dir first if they don't exist yet.
+
+ex) python benchmark_loader.py --dataset yang91 --scale 2 --benchmark_batches 200
+"""
+
+import logging
+import time
+
+import tensorflow as tf
+
+from helper import args, loader, utilty as util
+
+args.flags.DEFINE_integer("benchmark_batches", 100, "Number of mini-batches loaded for each loader")
+FLAGS = args.get()
+
+
+def measure(name, datasets, batch_num, batches, max_value):
+    datasets.init_batch_index()
+    datasets.next_batch(batch_num, max_value)
+
+    start_time = time.time()
+    for _ in range(batches):
+        datasets.next_batch(batch_num, max_value)
+    elapsed_time = time.time() - start_time
+
+    patches = batch_num * batches
+    logging.info("%-23s %8d patches in %6.2f sec: %10.1f patches/sec" % (name, patches, elapsed_time,
+                                                                               patches / elapsed_time))
+    datasets.log_stats()
+
+
+def load_batch_datasets(datasets, data_dir):
+    if datasets.is_batch_exist():
+        datasets.load_batch_counts()
+        datasets.load_all_batch_images()
+    else:
+        datasets.build_batch(data_dir)
+    return datasets
+
+
+def main(not_parsed_args):
+    if len(not_parsed_args) > 1:
+        print("Unknown args:%s" % not_parsed_args)
+        exit()
+
+    util.set_logging(FLAGS.log_filename, stream_log_level=logging.INFO, file_log_level=logging.INFO,
+                     tf_log_level=tf.logging.WARN)
+    data_dir = FLAGS.data_dir + "/" + FLAGS.dataset
+    batch_dir = FLAGS.batch_dir + "/" + FLAGS.dataset + "/scale%d/" % FLAGS.scale
+
+    batch = load_batch_datasets(
+        loader.BatchDataSets(FLAGS.scale, batch_dir + loader.BatchDataSets.STORE_TYPE,
+                             FLAGS.batch_image_size, FLAGS.stride_size,
+                             channels=FLAGS.channels, patches_cnt=FLAGS.patches_cnt), data_dir)
+    measure("BatchDataSets", batch, FLAGS.batch_num, FLAGS.benchmark_batches, FLAGS.max_value)
+    batch.release_batch_images()
+
+    compressed = load_batch_datasets(
+        loader.CompressedBatchDataSets(FLAGS.scale, batch_dir + loader.CompressedBatchDataSets.STORE_TYPE,
+                                       FLAGS.batch_image_size, FLAGS.stride_size,
+                                       channels=FLAGS.channels, patches_cnt=FLAGS.patches_cnt,
+                                       cache_blocks=FLAGS.compressed_cache_blocks), data_dir)
+    measure("CompressedBatchDataSets", compressed, FLAGS.batch_num, FLAGS.benchmark_batches, FLAGS.max_value)
+    compressed.release_batch_images()
+
+    random_crop = load_batch_datasets(
+        loader.RandomCropDataSets(FLAGS.scale, batch_dir + loader.RandomCropDataSets.STORE_TYPE,
+                                  FLAGS.batch_image_size, FLAGS.stride_size,
+                                  channels=FLAGS.channels, patches_cnt=FLAGS.patches_cnt), data_dir)
+    measure("RandomCropDataSets", random_crop, FLAGS.batch_num, FLAGS.benchmark_batches, FLAGS.max_value)
+    random_crop.release_batch_images()
+
+    dynamic = loader.DynamicDataSets(FLAGS.scale, FLAGS.batch_image_size, channels=FLAGS.channels)
+    dynamic.set_data_dir(data_dir)
+    measure("DynamicDataSets", dynamic, FLAGS.batch_num, FLAGS.benchmark_batches, FLAGS.max_value)
+
+
+if __name__ == '__main__':
+    tf.app.run()
@@ -7,17 +7,43 @@ Convert RGB(A)-(PNG or Jpeg) Image to Y-BMP images
 
 Put your images under data/[your dataset name]/ and specify [your dataset name] for --dataset.
 
+--convert_output shards: (default) Y planes are packed into a few large .npy shards with an offset index.
+                         build_batch and dynamic loading (build_batch=False) read them by memmap.
+--convert_output images: Y images are saved as BMP files like before.
 
+Files are processed by a pool of --convert_workers processes.
 """
+import multiprocessing
 import os
 
+import numpy as np
 import tensorflow as tf
 
-from helper import args, utilty as util
+from helper import args, color, loader, utilty as util
+
+args.flags.DEFINE_string("convert_output", "shards", "[shards, images] Pack Y planes into .npy shards or save BMP files")
+args.flags.DEFINE_integer("convert_workers", 0, "Number of worker processes. 0 uses all CPUs.")
+args.flags.DEFINE_integer("shard_mb", 256, "Size of each .npy shard (MB) for --convert_output shards")
 
 FLAGS = args.get()
 
 
+def save_y_image(worker_args):
+    """ save float Y rounded by util.save_image() like before. shards keep truncated Y like the patch store. """
+    file_path, target_dir = worker_args
+
+    image = util.load_image(file_path, print_console=False)
+    if image.shape[2] == 3:
+        image = color.rgb_to_y(image, dtype=np.float64)
+
+    filename, extension = os.path.splitext(os.path.basename(file_path))
+    util.save_image(target_dir + filename + ".bmp", image)
+
+
+def load_named_y_plane(file_path):
+    return os.path.basename(file_path), loader.load_y_plane(file_path)
+
+
 def main(not_parsed_args):
     if len(not_parsed_args) > 1:
         print("Unknown args:%s" % not_parsed_args)
@@ -29,16 +55,19 @@ def main(not_parsed_args):
     target_dir = FLAGS.data_dir + "/" + FLAGS.dataset + "_y/"
     util.make_dir(target_dir)
 
-    for file_path in training_filenames:
-        org_image = util.load_image(file_path)
-        if org_image.shape[2] == 3:
-            org_image = util.convert_rgb_to_y(org_image)
-
-        filename = os.path.basename(file_path)
-        filename, extension = os.path.splitext(filename)
-
-        new_filename = target_dir + filename
-        util.save_image(new_filename + ".bmp", org_image)
+    workers = FLAGS.convert_workers if FLAGS.convert_workers > 0 else multiprocessing.cpu_count()
+
+    with multiprocessing.Pool(workers) as pool:
+        if FLAGS.convert_output == "images":
+            worker_args = [(file_path, target_dir) for file_path in training_filenames]
+            for _ in pool.imap_unordered(save_y_image, worker_args):
+                pass
+        else:
+            # Y planes are written in file order as they are decoded, so only a shard is kept in memory
+            writer = loader.ShardWriter(target_dir, shard_bytes=FLAGS.shard_mb * 1024 * 1024)
+            for basename, y_image in pool.imap(load_named_y_plane, training_filenames, chunksize=4):
+                writer.add(basename, y_image)
+            writer.close()
 
 
 if __name__ == '__main__':
@@ -124,6 +124,7 @@ def main(not_parsed_args):
 def evaluate_bicubic(model, test_data):
     test_filenames = util.get_files_in_directory(FLAGS.data_dir + "/" + test_data)
     total_psnr = total_ssim = 0
+    model.reset_host_time()
 
     for filename in test_filenames:
         psnr, ssim, psnr_rgb, ssim_rgb = model.evaluate_bicubic(filename, print_console=False)
@@ -132,6 +133,7 @@ def evaluate_bicubic(model, test_data):
 
     logging.info("Bicubic Average [%s] PSNR:%f, SSIM:%f" % (
         test_data, total_psnr / len(test_filenames), total_ssim / len(test_filenames)))
+    logging.info("Bicubic Average [%s] Host pre/post processing (ms): %f" % (test_data, model.get_host_time() * 1000))
         
     return total_psnr / len(test_filenames), total_ssim / len(test_filenames)
 
@@ -139,6 +141,7 @@ def evaluate_model(model, test_data):
     test_filenames = util.get_files_in_directory(FLAGS.data_dir + "/" + test_data)
     total_psnr = total_ssim = total_time = 0
     total_psnr_rgb = total_ssim_rgb = 0
+    model.reset_host_time()
 
     for filename in test_filenames:
         start = time.time()
@@ -159,6 +162,9 @@ def evaluate_model(model, test_data):
         test_data, total_psnr / len(test_filenames), total_ssim / len(test_filenames), total_time / len(test_filenames)))
     logging.info("Model Average [%10s] PSNR_RGB:%f, SSIM_RGB:%f, Time (s): %f" % (
         test_data, total_psnr_rgb / len(test_filenames), total_ssim_rgb / len(test_filenames), total_time / len(test_filenames)))
+    logging.info("Model Average [%10s] Host pre/post processing (ms): %f" % (test_data, model.get_host_time() * 1000))
+    if model.eval_cache is not None:
+        model.eval_cache.log_stats()
 
 if __name__ == '__main__':
     tf.app.run()
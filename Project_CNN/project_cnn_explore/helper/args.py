@@ -51,9 +51,21 @@ flags.DEFINE_float("epsilon", 1e-8, "epsilon for adam optimizer")
 flags.DEFINE_float("momentum", 0.9, "Momentum for momentum optimizer and rmsprop optimizer")
 flags.DEFINE_integer("batch_num", 20, "Number of mini-batch images for training")
 flags.DEFINE_integer("batch_image_size", 48, "Image size for mini-batch")
-flags.DEFINE_integer("patches_cnt", 0, "Number of patches to be created for training")
+flags.DEFINE_integer("patches_cnt", 0, "Max number of patches to be created for training. 0 uses 200000 (scale <= 2) or "
+                                       "150000 patches unless patch_memory_mb is set. -1 uses all patches of the dataset")
+flags.DEFINE_integer("patch_memory_mb", 0, "Memory budget (MB) of the patch store. If all patches don't fit, a uniform "
+                                           "random sample of patches over all images is kept. 0 keeps all patches.")
+flags.DEFINE_string("patch_filter", "", "Drop flat patches when building the patch store. [variance, gradient] "
+                                       "(gradient: mean squared difference of neighbor pixels). Empty keeps all patches.")
+flags.DEFINE_float("patch_filter_threshold", 25.0, "Patches with texture score below this are dropped by patch_filter")
+flags.DEFINE_float("flat_patch_keep", 0.0, "Probability to keep a patch dropped by patch_filter anyway")
 flags.DEFINE_integer("stride_size", 0, "Stride size for mini-batch. If it is 0, use half of batch_image_size")
 flags.DEFINE_integer("training_images", 100000, "Number of training on each epoch")
+flags.DEFINE_integer("prefetch_batches", 0, "Number of mini-batches built ahead in a background thread while training. "
+                                            "0 builds each mini-batch in the training loop.")
+flags.DEFINE_boolean("tf_data_input", False, "Feed training mini-batches from a tf.data pipeline in the graph instead of "
+                                              "feed_dict. Evaluation still feeds x, x2 and y.")
+flags.DEFINE_integer("tf_data_workers", 4, "Number of parallel map calls building mini-batches in tf.data input mode.")
 flags.DEFINE_boolean("use_l1_loss", False, "Use L1 Error as loss function instead of MSE Error.")
 
 # Learning Rate Control for Training
@@ -85,6 +97,13 @@ flags.DEFINE_string("test_dataset", "bsd200", "Directory for test dataset [set5,
 flags.DEFINE_list("eval_tests_while_train", [], "Evaluate test sets while training @each epoch, each string should be ',' separated," 
                                                 "Directory for test dataset [set5, set14, bsd100, Urban100, all]")
 flags.DEFINE_integer("tests", 1, "Number of training sets")
+flags.DEFINE_boolean("eval_cache", True, "Keep prepared test images (LR / bicubic / true Y, bicubic CbCr) in RAM across "
+                                         "epochs and trials, so evaluation only runs the network and the metrics.")
+flags.DEFINE_integer("eval_cache_mb", 1024, "Memory budget (MB) of eval_cache. Test images over it are prepared at "
+                                            "each evaluation. 0 keeps all test images.")
+flags.DEFINE_string("eval_cache_dir", "", "If set, prepared test images are also saved here as .npz keyed by file "
+                                          "content hash, scale and compress_input_q.")
+flags.DEFINE_float("target_psnr", 0, "If > 0, log training time and steps when test PSNR first reaches this value")
 flags.DEFINE_boolean("do_benchmark", False, "Evaluate the performance for set5, set14 and bsd100 after the training.")
 
 # Image Processing
@@ -94,6 +113,36 @@ flags.DEFINE_integer("psnr_calc_border_size", -1,
                      "Cropping border size for calculating PSNR. if < 0, use 2 + scale for default.")
 flags.DEFINE_boolean("build_batch", True, "Build pre-processed input batch. Makes training significantly faster but "
                                            "the patches are limited to be on the grid.")
+flags.DEFINE_integer("image_cache_mb", 0, "Memory budget (MB) of decoded image LRU cache for build_batch=False training. "
+                                          "0 disables the cache.")
+flags.DEFINE_string("image_cache_dir", "", "If set, decoded images of the cache are also saved here as .npy and memmapped.")
+flags.DEFINE_integer("patches_per_image", 1, "Number of random patches cropped from each decoded image for "
+                                             "build_batch=False training. Crops are shuffled across upcoming mini-batches.")
+flags.DEFINE_boolean("reuse_batch", True, "Reuse the patch store in batch_dir when its manifest matches scale, stride, "
+                                           "batch_image_size, channels and compress_input_q. False forces rebuilding.")
+flags.DEFINE_integer("batch_workers", 0, "Number of worker processes for building batch images. 0 or 1 builds serially.")
+flags.DEFINE_boolean("patch_atlas", False, "Store each training image once in a memmapped atlas and index patches as "
+                                            "(image, y, x) offsets instead of copying every grid patch. Not for compress_input_q.")
+flags.DEFINE_boolean("random_crop_batch", False, "Keep decoded training images in memory (as the patch atlas) and crop "
+                                                  "patches at random offsets instead of on the grid.")
+flags.DEFINE_boolean("sharded_batch", False, "Save patches in shards and stream them from disk through a shuffle buffer "
+                                              "for datasets larger than memory.")
+flags.DEFINE_integer("patch_shard_mb", 256, "Size of each patch shard (MB) for sharded_batch")
+flags.DEFINE_integer("shuffle_buffer_mb", 256, "Size of the shuffle buffer (MB) for sharded_batch. Resident memory is "
+                                               "about shuffle_buffer_mb + patch_shard_mb.")
+flags.DEFINE_boolean("compressed_patches", False, "Keep patches of the patch store in memory compressed in blocks of 256 "
+                                                   "patches (lossless). Batches are drawn from a few blocks at a time.")
+flags.DEFINE_integer("compressed_cache_blocks", 16, "Number of decompressed blocks cached for compressed_patches")
+flags.DEFINE_integer("batch_augment_level", 1, "2-8: flip / rotate each training patch by a random one of the same "
+                                              "transforms as augmentation.py --augment_level, in the loader instead of on disk.")
+flags.DEFINE_boolean("in_graph_resize", False, "Feed only uint8 HR patches and build LR input and its bicubic "
+                                               "upscale in the graph with PIL compatible resize matrices.")
+flags.DEFINE_boolean("importance_sampling", False, "Sample patches with high running training loss more often, with "
+                                                   "importance weights on the loss. Needs build_batch, feed_dict input and an uncompressed patch store.")
+flags.DEFINE_float("importance_uniform_ratio", 0.2, "Ratio of uniform sampling mixed into importance_sampling. "
+                                                    "Also bounds importance weights to 1 / ratio.")
+flags.DEFINE_boolean("precompute_input", False, "Precompute LR and bicubic patches of the batch once instead of resizing "
+                                                 "on every training step. Needs extra memory (logged before building).")
 # flags.DEFINE_integer("input_image_width", -1, "The width of the input image. Put -1 if you do not want to have a fixed input size")
 # flags.DEFINE_integer("input_image_height", -1, "The height of the input image. Put -1 if you do not want to hae a fixed input size")
 
@@ -0,0 +1,112 @@
+"""
+Paper: "Fast and Accurate Image Super Resolution by Deep CNN with Skip Connection and Network in Network"
+Ver: 2
+
+color conversion kernels (ITU-R BT.601 YCbCr, 16-235 / 16-240 range)
+
+All functions work on [H, W, C] images and [N, H, W, C] batches, return float32 by default (dtype=) and can write
+into a preallocated array (out=). Channels are accumulated one by one, so no float copy of the whole input is made.
+rgb_to_y_uint8() converts uint8 RGB to uint8 Y with exact integer arithmetic.
+"""
+
+import numpy as np
+
+RGB_TO_YCBCR = np.array(
+    [[65.738 / 256.0, 129.057 / 256.0, 25.064 / 256.0],
+     [- 37.945 / 256.0, - 74.494 / 256.0, 112.439 / 256.0],
+     [112.439 / 256.0, - 94.154 / 256.0, - 18.285 / 256.0]])
+YCBCR_OFFSET = np.array([16.0, 128.0, 128.0])
+
+YCBCR_TO_RGB = np.array(
+    [[298.082 / 256.0, 0, 408.583 / 256.0],
+     [298.082 / 256.0, -100.291 / 256.0, -208.120 / 256.0],
+     [298.082 / 256.0, 516.412 / 256.0, 0]])
+# offset of rgb = YCBCR_TO_RGB @ (ycbcr - YCBCR_OFFSET)
+RGB_OFFSET = -YCBCR_TO_RGB.dot(YCBCR_OFFSET)
+
+# Y = (65738 R + 129057 G + 25064 B) / 256000 + 16 without rounding error
+Y_INT_WEIGHTS = (65738, 129057, 25064)
+Y_INT_DIVISOR = 256000
+
+
+def get_output(shape, out, dtype):
+    if out is None:
+        return np.empty(shape, dtype=dtype)
+    if tuple(out.shape) != tuple(shape):
+        raise ValueError("out has shape %s, %s expected" % (out.shape, shape))
+    return out
+
+
+def apply_color_matrix(channels, matrix, offset, out):
+    """ out[..., c] = sum_k matrix[c, k] * channels[k] + offset[c], with one [..., H, W] temporary. """
+
+    temp = np.empty(out.shape[:-1], dtype=out.dtype)
+    for c in range(matrix.shape[0]):
+        result = out[..., c]
+        result.fill(offset[c])
+        for k, channel in enumerate(channels):
+            if matrix[c, k] == 0:
+                continue
+            np.multiply(channel, matrix[c, k], out=temp, dtype=out.dtype, casting="unsafe")
+            result += temp
+    return out
+
+
+def rgb_to_y(image, out=None, dtype=np.float32):
+    """ [..., 3] RGB to [..., 1] Y. """
+
+    out = get_output(image.shape[:-1] + (1,), out, dtype)
+    channels = [image[..., k] for k in range(3)]
+    return apply_color_matrix(channels, RGB_TO_YCBCR[0:1], YCBCR_OFFSET[0:1], out)
+
+
+def rgb_to_y_uint8(image, out=None):
+    """
+    [..., 3] uint8 RGB to [..., 1] uint8 Y in integer fixed point. same as truncating exact Y (astype(np.uint8) of
+    float Y), without float rounding errors.
+    """
+
+    y = np.empty(image.shape[:-1], dtype=np.int32)
+    temp = np.empty(image.shape[:-1], dtype=np.int32)
+    np.multiply(image[..., 0], Y_INT_WEIGHTS[0], out=y, dtype=np.int32)
+    for k in (1, 2):
+        np.multiply(image[..., k], Y_INT_WEIGHTS[k], out=temp, dtype=np.int32)
+        y += temp
+    y //= Y_INT_DIVISOR
+    y += 16
+
+    out = get_output(image.shape[:-1] + (1,), out, np.uint8)
+    np.copyto(out[..., 0], y, casting="unsafe")
+    return out
+
+
+def rgb_to_ycbcr(image, out=None, dtype=np.float32):
+    """ [..., 3] RGB to [..., 3] YCbCr. """
+
+    out = get_output(image.shape, out, dtype)
+    channels = [image[..., k] for k in range(3)]
+    return apply_color_matrix(channels, RGB_TO_YCBCR, YCBCR_OFFSET, out)
+
+
+def rgb_to_cbcr(image, out=None, dtype=np.float32):
+    """ [..., 3] RGB to [..., 2] CbCr. """
+
+    out = get_output(image.shape[:-1] + (2,), out, dtype)
+    channels = [image[..., k] for k in range(3)]
+    return apply_color_matrix(channels, RGB_TO_YCBCR[1:3], YCBCR_OFFSET[1:3], out)
+
+
+def ycbcr_to_rgb(image, out=None, dtype=np.float32):
+    """ [..., 3] YCbCr to [..., 3] RGB. values are not clipped. """
+
+    out = get_output(image.shape, out, dtype)
+    channels = [image[..., k] for k in range(3)]
+    return apply_color_matrix(channels, YCBCR_TO_RGB, RGB_OFFSET, out)
+
+
+def y_and_cbcr_to_rgb(y_image, cbcr_image, out=None, dtype=np.float32):
+    """ [..., 1] Y and [..., 2] CbCr to [..., 3] RGB without building a YCbCr image. values are not clipped. """
+
+    out = get_output(y_image.shape[:-1] + (3,), out, dtype)
+    channels = [y_image[..., 0], cbcr_image[..., 0], cbcr_image[..., 1]]
+    return apply_color_matrix(channels, YCBCR_TO_RGB, RGB_OFFSET, out)
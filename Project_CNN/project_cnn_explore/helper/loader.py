@@ -5,28 +5,63 @@ Ver: 2
 functions for loading/converting data
 """
 
+import collections
 import configparser
+import hashlib
+import json
 import logging
+import multiprocessing
 import os
+import queue
 import random
+import threading
+import time
+import zlib
 
 import numpy as np
+from PIL import Image
 from scipy import misc
 
-from helper import utilty as util
+from helper import color, utilty as util
 import cv2
 
 INPUT_IMAGE_DIR = "input"
 INTERPOLATED_IMAGE_DIR = "interpolated"
 TRUE_IMAGE_DIR = "true"
+BATCH_CONFIG_FILE = "batch_images.ini"
+TRUE_IMAGES_FILE = "true_images.npy"
+COMPRESS_IMAGES_FILE = "compress_images_lr.npy"
+IMAGE_SIZES_FILE = "image_sizes.json"
+ATLAS_FILE = "atlas.npy"
+ATLAS_IMAGES_FILE = "atlas_images.npy"
+ATLAS_PATCHES_FILE = "atlas_patches.npy"
+SHARD_INDEX_FILE = "shards.json"
+PATCH_SHARDS_FILE = "patch_shards.npy"
+PATCH_SHARD_FILE = "patch_shard_%05d.npy"
+
+_image_shards = {}
+# number of images whose crops are mixed in DynamicDataSets patch pool
+PATCH_POOL_IMAGES = 32
 
 
 def build_image_set(file_path, channels=1, scale=1, convert_ycbcr=True, resampling_method="bicubic",
                     print_console=True):
+    shards = get_image_shards(os.path.dirname(file_path))
+    if shards is not None:
+        # packed uint8 Y plane. get_split_images() needs a contiguous image
+        if channels != 1 or not convert_ycbcr:
+            raise util.LoadError("Image shards have only Y channel [%s]" % file_path)
+        true_image = np.ascontiguousarray(util.set_image_alignment(shards.load_image(file_path), scale))
+        return true_image, true_image, true_image
+
     true_image = util.set_image_alignment(util.load_image(file_path, print_console=print_console), scale)
 
     if channels == 1 and true_image.shape[2] == 3 and convert_ycbcr:
-        true_image = util.convert_rgb_to_y(true_image)
+        # patches are stored as truncated uint8 Y
+        if true_image.dtype == np.uint8:
+            true_image = color.rgb_to_y_uint8(true_image)
+        else:
+            true_image = util.convert_rgb_to_y(true_image)
 
     # Avoid creating input, bicubic images, as they can be created from true image while training
     #input_image = util.resize_image_by_pil(true_image, 1.0 / scale, resampling_method=resampling_method)
@@ -36,6 +71,231 @@ def build_image_set(file_path, channels=1, scale=1, convert_ycbcr=True, resampli
     return true_image, true_image, true_image
 
 
+def get_image_shards(data_dir):
+    """ returns ImageShards of data_dir (opened once per process) if it has a shard index, otherwise None. """
+
+    data_dir = os.path.normpath(data_dir)
+    shards = _image_shards.get(data_dir)
+    if shards is None and ImageShards.is_shard_dir(data_dir):
+        shards = ImageShards(data_dir)
+        _image_shards[data_dir] = shards
+    return shards
+
+
+def get_image_files(data_dir):
+    """ image filenames of data_dir. for a shard dir, these are the names in its index. """
+
+    shards = get_image_shards(data_dir)
+    if shards is not None:
+        return list(shards.filenames)
+    return util.get_files_in_directory(data_dir)
+
+
+def load_y_plane(filename):
+    """ decode image and returns its Y as [H, W, 1] uint8 (truncated like the patches of BatchDataSets). """
+
+    image = util.load_image(filename, print_console=False)
+    if image.shape[2] == 3:
+        return color.rgb_to_y_uint8(image.astype(np.uint8, copy=False))
+    return image.astype(np.uint8)
+
+
+def get_temp_filename(filename, suffix=".tmp"):
+    """
+    returns a temporary file name next to filename, unique to this process and thread. several trainings building
+    the same store at once write their own temporary files, and os.replace() publishes only complete files.
+    """
+    return "%s.%d_%d%s" % (filename, os.getpid(), threading.get_ident(), suffix)
+
+
+def save_npy_file(filename, array):
+    """ save array as .npy through a temporary file, so a reader never sees a partially written file. """
+    temp_filename = get_temp_filename(filename)
+    with open(temp_filename, "wb") as f:
+        np.save(f, array)
+    os.replace(temp_filename, filename)
+
+
+def get_image_size(filename):
+    """ returns (width, height) of an image file. only the header is read. """
+    with Image.open(filename) as image:
+        return image.size
+
+
+def scan_image_sizes(filenames, manifest_filename):
+    """
+    returns dict of filename -> (width, height). Sizes are read from image headers only (no decode) and cached in
+    a JSON manifest with file modified time and size, so unchanged files are not opened again on later runs.
+    """
+
+    manifest = {}
+    if os.path.isfile(manifest_filename):
+        try:
+            with open(manifest_filename) as f:
+                manifest = json.load(f)
+        except (IOError, ValueError):
+            manifest = {}
+
+    image_sizes = {}
+    updated = False
+    for filename in filenames:
+        stat = os.stat(filename)
+        entry = manifest.get(filename)
+        if entry is None or entry["mtime"] != stat.st_mtime or entry["bytes"] != stat.st_size:
+            width, height = get_image_size(filename)
+            entry = {"width": width, "height": height, "mtime": stat.st_mtime, "bytes": stat.st_size}
+            manifest[filename] = entry
+            updated = True
+        image_sizes[filename] = (entry["width"], entry["height"])
+
+    if updated:
+        util.make_dir(os.path.dirname(manifest_filename))
+        temp_filename = get_temp_filename(manifest_filename)
+        with open(temp_filename, "w") as f:
+            json.dump(manifest, f)
+        os.replace(temp_filename, manifest_filename)
+
+    return image_sizes
+
+
+def get_split_count(height, width, window_size, stride, alignment=1):
+    """ number of patches util.get_split_images() returns for an image of this size after set_image_alignment(). """
+    height = (height // alignment) * alignment
+    width = (width // alignment) * alignment
+    if height < window_size or width < window_size:
+        return 0
+    return (1 + (height - window_size) // stride) * (1 + (width - window_size) // stride)
+
+
+def build_batch_patches(filename, scale, batch_image_size, stride, channels=1, resampling_method="bicubic",
+                        compress_input_q=0):
+    """
+    split one image into HR patches for BatchDataSets.
+    returns (true patches, compressed LR patches) as uint8 arrays. compressed patches are None when
+    compress_input_q <= 1. (None, None) is returned when the image is smaller than a patch.
+    """
+
+    output_window_size = batch_image_size * scale
+    output_window_stride = stride * scale
+
+    if compress_input_q > 1:
+        # read RGB HR image
+        input_image_rgb, input_interpolated_image_rgb, true_image_rgb = \
+            build_image_set(filename, channels=3, resampling_method=resampling_method,
+                            scale=scale, print_console=False)
+
+        # split RGB HR image into [N, H, W, 3] patches
+        batch_HR_rgb = util.get_split_images(true_image_rgb.astype(np.uint8), output_window_size, stride=output_window_stride)
+        if batch_HR_rgb is None:
+            return None, None
+
+        compress_batch_images = compress_patches_with_jpeg(batch_HR_rgb, compress_input_q, scale, resampling_method)
+        true_batch_images = color.rgb_to_y_uint8(batch_HR_rgb)
+
+        return true_batch_images, compress_batch_images
+    else:
+        # Read RGB HR and convert to YUV HR
+        input_image, input_interpolated_image, true_image = \
+            build_image_set(filename, channels=channels, resampling_method=resampling_method,
+                            scale=scale, print_console=False)
+
+        # split Y_HR images
+        true_batch_images = util.get_split_images(true_image, output_window_size, stride=output_window_stride)
+        if true_batch_images is None:
+            return None, None
+
+        return true_batch_images.astype(np.uint8), None
+
+
+def compress_patches_with_jpeg(batch_HR_rgb, compress_input_q, scale, resampling_method="bicubic"):
+    """
+    Each patch: downscale->compress. [N, H, W, 3] uint8 RGB HR patches to [N, H/scale, W/scale, 1] uint8 LR y patches.
+    """
+
+    input_count = batch_HR_rgb.shape[0]
+    lr_size = batch_HR_rgb.shape[1] // scale
+    batch_LR_rgb = np.empty(shape=[input_count, lr_size, lr_size, 3], dtype=np.uint8)
+    encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), compress_input_q]
+
+    # create LR RGB images of all patches at once
+    resized_LR_rgb = util.resize_images(batch_HR_rgb, 1.0 / scale, resampling_method=resampling_method)
+
+    for i in range(input_count):
+        # compress LR RGB image: encode and decode
+        ret, enc_img = cv2.imencode('.jpg', resized_LR_rgb[i], encode_param)
+        batch_LR_rgb[i] = cv2.imdecode(enc_img, 1)
+
+    # convert y for all patches at once
+    return color.rgb_to_y_uint8(batch_LR_rgb)
+
+
+def build_batch_patches_to_store(worker_args):
+    """ worker of BatchDataSets.build_batch_to_store_files(): build patches of one image and write them at its offset. """
+
+    filename, offset, input_count, true_filename, compress_filename, scale, batch_image_size, stride, channels, \
+        resampling_method, compress_input_q, selected = worker_args
+
+    true_batch_images, compress_batch_images = build_batch_patches(
+        filename, scale, batch_image_size, stride, channels=channels, resampling_method=resampling_method,
+        compress_input_q=compress_input_q)
+    true_batch_images, compress_batch_images = select_batch_patches(true_batch_images, compress_batch_images,
+                                                                    selected)
+    if true_batch_images is None or true_batch_images.shape[0] != input_count:
+        raise util.LoadError("Unexpected patch count from [%s]" % filename)
+
+    true_images = np.load(true_filename, mmap_mode="r+")
+    true_images[offset:offset + input_count] = true_batch_images
+    true_images.flush()
+    if compress_filename is not None:
+        compress_images_lr = np.load(compress_filename, mmap_mode="r+")
+        compress_images_lr[offset:offset + input_count] = compress_batch_images
+        compress_images_lr.flush()
+
+    return input_count
+
+
+def select_batch_patches(true_batch_images, compress_batch_images, selected):
+    """ keep only selected patch numbers of an image (see BatchDataSets.sample_batch_tasks()). None keeps all. """
+
+    if selected is None or true_batch_images is None:
+        return true_batch_images, compress_batch_images
+    if compress_batch_images is not None:
+        compress_batch_images = compress_batch_images[selected]
+    return true_batch_images[selected], compress_batch_images
+
+
+def get_texture_scores(patches, method="gradient"):
+    """
+    texture score of each [N, H, W, 1] patch. "variance": variance of pixels, "gradient": mean squared difference of
+    horizontal and vertical neighbors (gradient energy). flat patches have scores close to 0.
+    """
+
+    patches = patches.astype(np.float32)
+    if method == "variance":
+        return patches.reshape(patches.shape[0], -1).var(axis=1)
+    elif method == "gradient":
+        return np.square(np.diff(patches, axis=1)).mean(axis=(1, 2, 3)) + \
+            np.square(np.diff(patches, axis=2)).mean(axis=(1, 2, 3))
+    else:
+        raise ValueError("Unknown patch filter [%s]" % method)
+
+
+def augment_batch_images(batches, augment_level):
+    """
+    flip / rotate each patch of the mini-batch in place by a random one of the first augment_level util.flip() types.
+    the same type is used for a patch in all batches (input, interpolated, true). patches are grouped by type so
+    each type is one vectorized copy.
+    """
+
+    flip_types = np.random.randint(augment_level, size=batches[0].shape[0])
+    for flip_type in range(1, augment_level):
+        image_nos = np.flatnonzero(flip_types == flip_type)
+        if len(image_nos) == 0:
+            continue
+        for batch in batches:
+            batch[image_nos] = util.flip_batch(batch[image_nos], flip_type)
+
+
 def load_input_image(filename, width=0, height=0, channels=1, scale=1, alignment=0, convert_ycbcr=True,
                      print_console=True):
     image = util.load_image(filename, print_console=print_console)
@@ -70,8 +330,292 @@ def build_input_image(image, width=0, height=0, channels=1, scale=1, alignment=0
     return image
 
 
-class BatchDataSets:
-    def __init__(self, scale, batch_dir, batch_image_size, stride_size=0, channels=1, resampling_method="bicubic", patches_cnt=0, compress_input_q=0):
+class SRImage:
+    """
+    Pre / post processing of one image for super resolution and its evaluation.
+    downscale=True: image is the (aligned) true image. LR input is made by downscaling (or JPEG compressing) it.
+    downscale=False: image is the LR input itself.
+    For a color image with channels=1, LR Y and bicubic Y are built at once. Bicubic CbCr is only needed for RGB
+    output, so it is built on first use of bicubic_cbcr and kept. to_rgb() merges the network output Y with bicubic
+    CbCr into a clipped uint8 RGB image.
+    host_time is the time spent in this object (sec).
+    """
+
+    def __init__(self, image, scale, channels=1, resampling_method="bicubic", compress_input_q=0, downscale=True):
+
+        start_time = time.time()
+        self.scale = scale
+        self.resampling_method = resampling_method
+        self.is_color = image.shape[2] == 3 and channels == 1
+        self.true_image = image if downscale else None
+        self.bicubic_rgb = None
+        self.true_y = None
+        # LR CbCr of a JPEG compressed input. None: built from true_image when needed
+        self.cbcr_lr = None
+        self.cbcr = None
+
+        if not downscale:
+            # super resolution of the given image
+            if self.is_color:
+                self.input_y = color.rgb_to_y(image)
+                self.bicubic_rgb = util.resize_image_by_pil(image, scale, resampling_method=resampling_method)
+            else:
+                self.input_y = image
+        elif self.is_color:
+            self.true_y = color.rgb_to_y(image)
+            if compress_input_q > 1:
+                # CbCr come from the compressed LR image
+                self.input_y, u_lr, v_lr = util.compress_with_jpeg(image, compress_input_q, scale, resampling_method)
+                self.cbcr_lr = np.concatenate([u_lr, v_lr], axis=2).astype(np.float32)
+            else:
+                self.input_y = util.resize_image_by_pil(self.true_y, 1.0 / scale, resampling_method=resampling_method)
+        else:
+            self.true_y = image
+            if compress_input_q > 1:
+                self.input_y = util.compress_with_jpeg(image, compress_input_q, scale, resampling_method)[0]
+            else:
+                self.input_y = util.resize_image_by_pil(image, 1.0 / scale, resampling_method=resampling_method)
+
+        self.bicubic_y = util.resize_image_by_pil(self.input_y, scale, resampling_method=resampling_method)
+        if self.bicubic_rgb is None:
+            self.bicubic_rgb = self.bicubic_y
+
+        self.host_time = time.time() - start_time
+
+    @property
+    def bicubic_cbcr(self):
+        """ bicubic up-scaled CbCr of a color image. None for a gray image. """
+
+        if self.cbcr is not None or not self.is_color:
+            return self.cbcr
+
+        start_time = time.time()
+        if self.true_image is None:
+            self.cbcr = color.rgb_to_cbcr(self.bicubic_rgb)
+        else:
+            cbcr_lr = self.cbcr_lr
+            if cbcr_lr is None:
+                # only CbCr planes: Y was converted in __init__
+                cbcr = color.rgb_to_cbcr(self.true_image)
+                cbcr_lr = [util.resize_image_by_pil(cbcr[:, :, c:c + 1], 1.0 / self.scale,
+                                                    resampling_method=self.resampling_method) for c in range(2)]
+            else:
+                cbcr_lr = [cbcr_lr[:, :, c:c + 1] for c in range(2)]
+
+            # bicubic up-scale u, v channels straight into one CbCr image
+            self.cbcr = np.empty(self.bicubic_y.shape[0:2] + (2,), dtype=np.float32)
+            for c in range(2):
+                self.cbcr[:, :, c] = util.resize_image_by_pil(cbcr_lr[c], self.scale,
+                                                              resampling_method=self.resampling_method)[:, :, 0]
+
+        self.host_time += time.time() - start_time
+        return self.cbcr
+
+    def get_nbytes(self):
+        """ bytes of the arrays, counting bicubic CbCr of a color image even before it is built. """
+
+        nbytes = sum(array.nbytes for array in (self.true_image, self.input_y, self.bicubic_y, self.true_y,
+                                                self.cbcr_lr) if array is not None)
+        if self.is_color:
+            nbytes += self.bicubic_y.nbytes * 2
+        return nbytes
+
+    def to_rgb(self, output_y):
+        """ returns uint8 RGB image of output_y (network output) and bicubic CbCr. """
+
+        start_time = time.time()
+        rgb_image = color.y_and_cbcr_to_rgb(output_y, self.bicubic_cbcr)
+        np.rint(rgb_image, out=rgb_image)
+        np.clip(rgb_image, 0, 255, out=rgb_image)
+        rgb_image = rgb_image.astype(np.uint8)
+
+        self.host_time += time.time() - start_time
+        return rgb_image
+
+    def save(self, filename):
+        """ save arrays of a downscaled image (evaluation fixture) as .npz through a temporary file. """
+
+        arrays = {"true_image": self.true_image, "input_y": self.input_y, "bicubic_y": self.bicubic_y,
+                  "true_y": self.true_y, "scale": np.array(self.scale), "is_color": np.array(self.is_color),
+                  "resampling_method": np.array(self.resampling_method)}
+        for name in ("cbcr_lr", "cbcr"):
+            if getattr(self, name) is not None:
+                arrays[name] = getattr(self, name)
+
+        temp_filename = get_temp_filename(filename)
+        with open(temp_filename, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(temp_filename, filename)
+
+    @classmethod
+    def load(cls, filename):
+        """ returns SRImage saved by save(). """
+
+        sr_image = cls.__new__(cls)
+        with np.load(filename) as data:
+            sr_image.true_image = data["true_image"]
+            sr_image.input_y = data["input_y"]
+            sr_image.bicubic_y = data["bicubic_y"]
+            sr_image.true_y = data["true_y"]
+            sr_image.cbcr_lr = data["cbcr_lr"] if "cbcr_lr" in data else None
+            sr_image.cbcr = data["cbcr"] if "cbcr" in data else None
+            sr_image.scale = int(data["scale"])
+            sr_image.is_color = bool(data["is_color"])
+            sr_image.resampling_method = str(data["resampling_method"])
+        sr_image.bicubic_rgb = sr_image.bicubic_y
+        sr_image.host_time = 0.0
+        return sr_image
+
+
+class EvalFixtureCache:
+    """
+    Cache of evaluation fixtures (SRImage of test images) kept in RAM across epochs and trials. Loading, alignment,
+    color conversion, down / up scaling and JPEG compression of a test image don't change between epochs.
+    Fixtures are added until max_bytes (0: no limit) is used. Nothing is evicted: test sets are evaluated in the same
+    order every time, so LRU eviction would miss on every image once the set doesn't fit.
+    With cache_dir, fixtures are also saved as .npz named by a hash of the file content and the fixture key, so later
+    runs don't prepare them again. Cached arrays are read only.
+    """
+
+    def __init__(self, cache_dir="", max_bytes=0):
+
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.fixtures = {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+        if cache_dir != "":
+            util.make_dir(cache_dir)
+
+    def get(self, filename, key, load_function):
+        """
+        returns cached SRImage of filename for key (a string of the fixture parameters like scale and quality).
+        load_function(filename) is called when it is not cached. None results are not cached.
+        """
+
+        start_time = time.time()
+        sr_image = self.fixtures.get((filename, key))
+        if sr_image is not None:
+            self.hits += 1
+            sr_image.host_time = time.time() - start_time
+            return sr_image
+        self.misses += 1
+
+        cache_filename = None
+        if self.cache_dir != "":
+            cache_filename = self.get_cache_filename(filename, key)
+            if os.path.isfile(cache_filename):
+                try:
+                    sr_image = SRImage.load(cache_filename)
+                    sr_image.host_time = time.time() - start_time
+                except (IOError, KeyError, ValueError):
+                    logging.warning("Can't load eval fixture [%s]. Rebuilding it." % cache_filename)
+                    sr_image = None
+
+        if sr_image is None:
+            sr_image = load_function(filename)
+            if sr_image is None:
+                return None
+            if cache_filename is not None:
+                sr_image.save(cache_filename)
+
+        nbytes = sr_image.get_nbytes()
+        if self.max_bytes > 0 and self.bytes + nbytes > self.max_bytes:
+            return sr_image
+
+        for array in (sr_image.true_image, sr_image.input_y, sr_image.bicubic_y, sr_image.true_y,
+                      sr_image.cbcr_lr, sr_image.cbcr):
+            if array is not None:
+                array.setflags(write=False)
+        self.fixtures[(filename, key)] = sr_image
+        self.bytes += nbytes
+        return sr_image
+
+    def get_cache_filename(self, filename, key):
+
+        with open(filename, "rb") as f:
+            content_hash = hashlib.sha1(f.read()).hexdigest()
+        name = os.path.splitext(os.path.basename(filename))[0]
+        return self.cache_dir + "/%s_%s_%s.npz" % (name, content_hash[:16], key)
+
+    def log_stats(self, reset=True):
+        if self.hits + self.misses > 0:
+            logging.info("Eval fixture cache: {} images, {:,} bytes, hits:{} misses:{}".format(
+                len(self.fixtures), self.bytes, self.hits, self.misses))
+        if reset:
+            self.hits = 0
+            self.misses = 0
+
+
+class BatchIndexMixin:
+    """
+    Shuffled batch index and mini-batch buffer ring shared by BatchDataSets and DynamicDataSets.
+    Needs count, batch_image_size, scale, batch_buffer_count, batch_buffers and get_batch_images().
+    """
+
+    def init_batch_index(self):
+        self.batch_index = np.random.permutation(self.count)
+        self.index = 0
+
+    def get_next_image_no(self):
+
+        if self.index >= self.count:
+            self.init_batch_index()
+
+        image_no = self.batch_index[self.index]
+        self.index += 1
+        return image_no
+
+    def get_next_batch_index(self, batch_num):
+        """ returns next batch_num image numbers of the permutation as an array. re-shuffles when it is used up. """
+
+        if self.index + batch_num <= self.count:
+            image_nos = self.batch_index[self.index:self.index + batch_num]
+            self.index += batch_num
+            return image_nos
+
+        image_nos = np.empty(batch_num, dtype=np.int64)
+        for i in range(batch_num):
+            image_nos[i] = self.get_next_image_no()
+        return image_nos
+
+    def set_batch_buffer_count(self, count):
+        """ number of mini-batch buffers next_batch() rotates. must be larger than batches in use at once. """
+        self.batch_buffer_count = count
+        self.batch_buffers = None
+
+    def get_batch_buffers(self, batch_num):
+
+        if self.batch_buffers is None or self.batch_buffers.batch_num != batch_num:
+            self.batch_buffers = BatchBuffers(batch_num, self.batch_image_size, self.batch_image_size * self.scale,
+                                              count=self.batch_buffer_count)
+        return self.batch_buffers
+
+    def next_batch(self, batch_num, max_value, image_nos=None):
+        """
+        returns next mini-batch as contiguous float32 (batch_num, H, W, 1) arrays: input, interpolated and true.
+        arrays are taken from a ring of preallocated buffers, so they are overwritten by later next_batch() calls.
+        image_nos: patch numbers of the mini-batch (ex. from ImportanceSampler). None uses the shuffled batch index.
+        """
+
+        if image_nos is None:
+            image_nos = self.get_next_batch_index(batch_num)
+        return self.get_batch_images(image_nos, max_value, out=self.get_batch_buffers(batch_num).next())
+
+
+class BatchDataSets(BatchIndexMixin):
+    # kind of patch store saved in batch_dir. checked by is_batch_exist()
+    STORE_TYPE = "patches"
+    # True when patch numbers don't identify patches (random crops / streamed patches)
+    RANDOM_PATCHES = False
+    # True: serial build writes patches into the memmapped store files instead of an in-memory array
+    BUILD_TO_STORE_FILES = False
+
+    def __init__(self, scale, batch_dir, batch_image_size, stride_size=0, channels=1, resampling_method="bicubic", patches_cnt=0, compress_input_q=0,
+                 batch_workers=0, augment_level=1, patch_memory_mb=0, patch_filter="", patch_filter_threshold=0,
+                 flat_patch_keep=0):
 
         self.scale = scale
         self.batch_image_size = batch_image_size
@@ -84,20 +628,44 @@ class BatchDataSets:
         self.count = 0
         self.batch_dir = batch_dir
         self.batch_index = None
+        # 0: limit patches like before (200k for scale <= 2, 150k for others) unless patch_memory_mb limits them.
+        # -1: use all patches of the data directory
         self.patches_cnt = patches_cnt
-        if self.patches_cnt == 0:
-            if self.scale <= 2:
-                self.patches_cnt = 200000
-            else:
-                self.patches_cnt = 150000
+        if patches_cnt == 0 and patch_memory_mb <= 0:
+            self.patches_cnt = 200000 if scale <= 2 else 150000
+        # > 0: keep a uniform random sample of all patches which fits in this memory (MB)
+        self.patch_memory_mb = patch_memory_mb
+        # "variance" or "gradient": drop patches whose texture score is below patch_filter_threshold.
+        # flat_patch_keep of them are kept at random.
+        self.patch_filter = patch_filter
+        self.patch_filter_threshold = patch_filter_threshold
+        self.flat_patch_keep = flat_patch_keep
         self.compress_input_q = compress_input_q
+        self.batch_workers = batch_workers
+        # 2-8: each patch of a mini-batch is flipped / rotated by a random one of the first augment_level util.flip() types
+        self.augment_level = augment_level
+        self.input_images = None
+        self.input_interpolated_images = None
+        self.batch_buffer_count = 2
+        self.batch_buffers = None
 
     def build_batch(self, data_dir):
         """ Build batch images and. """
 
         print("Building batch images for %s..." % self.batch_dir)
-        filenames = util.get_files_in_directory(data_dir)
-        images_count = 0
+        self.check_image_shards(data_dir)
+        filenames = get_image_files(data_dir)
+        start_time = time.time()
+
+        tasks, patches_cnt = self.get_batch_tasks(filenames)
+        tasks, selections, patches_cnt = self.sample_batch_tasks(tasks, patches_cnt)
+        window_size = self.batch_image_size * self.scale
+        logging.info("Patch store size: %d patches, %.1f MB" % (patches_cnt,
+                                                                patches_cnt * window_size * window_size / 1024 / 1024))
+
+        if self.batch_workers > 1 or self.BUILD_TO_STORE_FILES:
+            self.build_batch_to_store_files(tasks, selections, patches_cnt, start_time)
+            return
 
         #util.make_dir(self.batch_dir)
         #util.clean_dir(self.batch_dir)
@@ -105,14 +673,12 @@ class BatchDataSets:
         #util.make_dir(self.batch_dir + "/" + INTERPOLATED_IMAGE_DIR)
         #util.make_dir(self.batch_dir + "/" + TRUE_IMAGE_DIR)
 
-        patches_cnt = self.patches_cnt
-        
         # allocate memory for patches
         hr_patch_dim = self.batch_image_size * self.scale
         pmem1 = hr_patch_dim * hr_patch_dim
         patches_mem1 = patches_cnt * pmem1        
-        self.true_images = np.zeros(
-            shape=[patches_cnt+1500, self.batch_image_size * self.scale, self.batch_image_size * self.scale, 1],
+        self.true_images = np.empty(
+            shape=[patches_cnt, self.batch_image_size * self.scale, self.batch_image_size * self.scale, 1],
             dtype=np.uint8)
         logging.info("Allocated HR ({}x{}) patches_cnt: {}, patches_mem1: {}".format(hr_patch_dim, hr_patch_dim, patches_cnt, patches_mem1))                    
         
@@ -120,97 +686,281 @@ class BatchDataSets:
         if self.compress_input_q > 1:
             pmem2 = self.batch_image_size * self.batch_image_size
             patches_mem2 = patches_cnt * pmem2
-            self.compress_images_lr = np.zeros(
-                shape=[patches_cnt+1500, self.batch_image_size, self.batch_image_size, 1],
+            self.compress_images_lr = np.empty(
+                shape=[patches_cnt, self.batch_image_size, self.batch_image_size, 1],
                 dtype=np.uint8)                   
             logging.info("Allocated compressed (y) patches_cnt: {}, patches_mem2: {}".format(patches_cnt, patches_mem2))    
             
         processed_images = 0
-        for filename in filenames:
-            output_window_size = self.batch_image_size * self.scale
-            output_window_stride = self.stride * self.scale
-
-            if self.compress_input_q > 1:  
-                # read RGB HR image
-                input_image_rgb, input_interpolated_image_rgb, true_image_rgb = \
-                    build_image_set(filename, channels=3, resampling_method=self.resampling_method,
-                                    scale=self.scale, print_console=False)  
-                                    
-                # split each RGB channel and batch
-                batch_HR_r = util.get_split_images(true_image_rgb[:,:,0:1].astype(np.uint8), output_window_size, stride=output_window_stride)                
-                batch_HR_g = util.get_split_images(true_image_rgb[:,:,1:2].astype(np.uint8), output_window_size, stride=output_window_stride)                
-                batch_HR_b = util.get_split_images(true_image_rgb[:,:,2:3].astype(np.uint8), output_window_size, stride=output_window_stride)                
-                if batch_HR_r is None:
-                    # if the original image size * scale is less than batch image size
-                    continue
-                    
-                # concat each r,g,b batch images
-                batch_HR_rgb = np.zeros(shape=[batch_HR_r.shape[0], batch_HR_r.shape[1], batch_HR_r.shape[2], 3], dtype=np.uint8)
-                batch_HR_rgb[:,:,:,0:1] = batch_HR_r
-                batch_HR_rgb[:,:,:,1:2] = batch_HR_g
-                batch_HR_rgb[:,:,:,2:3] = batch_HR_b   
-
-                # Each patch: downscale->compress->convert_to_y
-                input_count = batch_HR_rgb.shape[0]
-                for i in range(input_count):
-                    # create LR RGB image
-                    image_lr_rgb = util.resize_image_by_pil(batch_HR_rgb[i], 1.0 / self.scale, resampling_method=self.resampling_method)
-                                        
-                    # compress LR RGB image: encode and decode
-                    encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), self.compress_input_q]
-                    ret, enc_img = cv2.imencode('.jpg', image_lr_rgb, encode_param)
-                    dec_img = cv2.imdecode(enc_img, 1) 
-                    
-                    # convert y
-                    image_lr_y = util.convert_rgb_to_y(dec_img)
-                    image_hr_y = util.convert_rgb_to_y(batch_HR_rgb[i])
-                    
-                    # save compressed LR y images
-                    self.compress_images_lr[images_count] = image_lr_y    
-                    # save uncompressed HR y image
-                    self.true_images[images_count] = image_hr_y                                    
-                    images_count += 1
-            else:
-                # Read RGB HR and convert to YUV HR
-                input_image, input_interpolated_image, true_image = \
-                    build_image_set(filename, channels=self.channels, resampling_method=self.resampling_method,
-                                    scale=self.scale, print_console=False)   
-
-                # split Y_HR images
-                true_batch_images = util.get_split_images(true_image, output_window_size, stride=output_window_stride)
-                if true_batch_images is None:
-                    # if the original image size * scale is less than batch image size
-                    continue
-                input_count = true_batch_images.shape[0]
-
-                for i in range(input_count):
-                    self.true_images[images_count] = true_batch_images[i]                                    
-                    images_count += 1
-
-            if (images_count * pmem1) > (patches_mem1 - 100000):
-                logging.info(" ### Stopping patch process: Increase patches memory to process remaining patches also")                
-                break
-                
+        for (filename, offset, input_count), selected in zip(tasks, selections):
+            true_batch_images, compress_batch_images = build_batch_patches(
+                filename, self.scale, self.batch_image_size, self.stride, channels=self.channels,
+                resampling_method=self.resampling_method, compress_input_q=self.compress_input_q)
+            true_batch_images, compress_batch_images = select_batch_patches(true_batch_images,
+                                                                            compress_batch_images, selected)
+            if true_batch_images is None or true_batch_images.shape[0] != input_count:
+                raise util.LoadError("Unexpected patch count from [%s]" % filename)
+
+            self.true_images[offset:offset + input_count] = true_batch_images
+            if self.compress_input_q > 1:
+                self.compress_images_lr[offset:offset + input_count] = compress_batch_images
+
             processed_images += 1
             if processed_images % 10 == 0:
                 print('.', end='', flush=True)
 
+        patches_cnt = self.filter_flat_patches(self.true_images,
+                                               self.compress_images_lr if self.compress_input_q > 1 else None,
+                                               patches_cnt)
+
+        elapsed_time = time.time() - start_time
         logging.info(" ... Finished batch creation.")
         logging.info(" ... Processed images count: {}".format(processed_images))        
+        logging.info(" ... Built {} patches in {:.1f} sec ({:.1f} patches/sec)".format(
+            patches_cnt, elapsed_time, patches_cnt / max(elapsed_time, 1e-6)))
+        self.count = patches_cnt
+
+        logging.info("%d mini-batch images are built(saved).\n" % patches_cnt)
+
+        self.save_batch_images()
+
+    def get_batch_tasks(self, filenames):
+        """
+        Compute exact patch count of each image from the image size manifest (only headers are read) or the
+        index of image shards. returns list of (filename, offset, patch count) and total patch count.
+        When patches_cnt is set, images whose patches don't fit in the limit are skipped (and logged).
+        """
+
+        window_size = self.batch_image_size * self.scale
+        window_stride = self.stride * self.scale
+        image_sizes = self.get_image_sizes(filenames)
+
+        tasks = []
+        images_count = 0
+        all_count = 0
+        for filename in filenames:
+            width, height = image_sizes[filename]
+            input_count = get_split_count(height, width, window_size, window_stride, alignment=self.scale)
+            if input_count <= 0:
+                # if the original image size * scale is less than batch image size
+                continue
+            all_count += input_count
+            if self.patches_cnt > 0 and images_count + input_count > self.patches_cnt:
+                continue
+            tasks.append((filename, images_count, input_count))
+            images_count += input_count
+
+        if images_count < all_count:
+            logging.info(" ### patches_cnt limit: using %d of %d patches (%d images). Set patches_cnt -1 to use all." % (
+                images_count, all_count, len(tasks)))
+        logging.info("Building %d patches from %d images" % (images_count, len(tasks)))
+
+        return tasks, images_count
+
+    def check_image_shards(self, data_dir):
+        """ images of a dir packed by augmentation.py / convert_y.py are read from its shards without decoding. """
+
+        if get_image_shards(data_dir) is None:
+            return
+        if self.channels != 1 or self.compress_input_q > 1:
+            raise util.LoadError("Image shards in [%s] have only Y channel. They can't be used with channels=%d, "
+                                 "compress_input_q=%d." % (data_dir, self.channels, self.compress_input_q))
+        logging.info("Reading packed Y images from shards in [%s]" % data_dir)
+
+    def get_image_sizes(self, filenames):
+        """ returns dict of filename -> (width, height) from the shard index or the image size manifest. """
+
+        image_sizes = {}
+        other_filenames = []
+        for filename in filenames:
+            shards = get_image_shards(os.path.dirname(filename))
+            if shards is not None:
+                width, height = shards.get_image_size(filename)
+                image_sizes[filename] = (width, height)
+            else:
+                other_filenames.append(filename)
+
+        if other_filenames:
+            image_sizes.update(scan_image_sizes(other_filenames, self.batch_dir + "/" + IMAGE_SIZES_FILE))
+        return image_sizes
+
+    def filter_flat_patches(self, true_images, compress_images_lr, images_count, chunk_patches=4096):
+        """
+        drop patches whose texture score (get_texture_scores()) is below patch_filter_threshold, chunk by chunk.
+        kept patches are moved to the head of the arrays (in place, order is kept). returns the number of kept patches.
+        """
+
+        if not self.patch_filter:
+            return images_count
+
+        kept_count = 0
+        for start in range(0, images_count, chunk_patches):
+            end = min(start + chunk_patches, images_count)
+            chunk = np.array(true_images[start:end])
+            kept = get_texture_scores(chunk, self.patch_filter) >= self.patch_filter_threshold
+            if self.flat_patch_keep > 0:
+                kept |= np.random.random_sample(len(kept)) < self.flat_patch_keep
+            kept = np.flatnonzero(kept)
+
+            true_images[kept_count:kept_count + len(kept)] = chunk[kept]
+            if compress_images_lr is not None:
+                compress_images_lr[kept_count:kept_count + len(kept)] = compress_images_lr[start:end][kept]
+            kept_count += len(kept)
+
+        logging.info(" ### patch_filter (%s < %g): kept %d of %d patches (%.1f%%)" % (
+            self.patch_filter, self.patch_filter_threshold, kept_count, images_count,
+            100.0 * kept_count / max(images_count, 1)))
+        return kept_count
+
+    def sample_batch_tasks(self, tasks, images_count):
+        """
+        When patches don't fit in patch_memory_mb, select a uniform random sample of them over all images.
+        Patch counts of all images are known from get_batch_tasks(), so the sample is drawn at once
+        (same distribution as reservoir sampling over the stream of patches) and images without any selected
+        patch are not decoded at all.
+        returns tasks with new offsets / counts, selected patch numbers of each task (None: all) and total count.
+        """
+
+        window_size = self.batch_image_size * self.scale
+        patch_bytes = window_size * window_size
+        if self.compress_input_q > 1:
+            patch_bytes += self.batch_image_size * self.batch_image_size
+        capacity = int(self.patch_memory_mb * 1024 * 1024 // patch_bytes)
+
+        if self.patch_memory_mb <= 0 or images_count <= capacity:
+            return tasks, [None] * len(tasks), images_count
+
+        selected = np.sort(np.random.choice(images_count, capacity, replace=False))
+        sampled_tasks = []
+        selections = []
+        sampled_count = 0
+        for filename, offset, input_count in tasks:
+            start, end = [int(i) for i in np.searchsorted(selected, [offset, offset + input_count])]
+            if end <= start:
+                continue
+            sampled_tasks.append((filename, sampled_count, end - start))
+            selections.append(selected[start:end] - offset)
+            sampled_count += end - start
+
+        logging.info(" ### patch_memory_mb limit: sampled %d of %d patches from %d of %d images." % (
+            sampled_count, images_count, len(sampled_tasks), len(tasks)))
+        return sampled_tasks, selections, sampled_count
+
+    def build_batch_to_store_files(self, tasks, selections, images_count, start_time):
+        """
+        Build batch images with a pool of batch_workers processes (serially for batch_workers <= 1).
+        Each file has a fixed offset in the store (from get_batch_tasks()), so workers write their patches
+        directly into the memmapped store files. Patch order is same as serial build.
+        """
+
+        window_size = self.batch_image_size * self.scale
+        if self.batch_workers > 1:
+            logging.info("Building with %d workers" % self.batch_workers)
+
+        util.make_dir(self.batch_dir)
+        if os.path.isfile(self.batch_dir + "/" + BATCH_CONFIG_FILE):
+            os.remove(self.batch_dir + "/" + BATCH_CONFIG_FILE)
+
+        # not .tmp: save_npy_file() of filtered patches writes its own temporary file while this one is read
+        true_filename = get_temp_filename(self.batch_dir + "/" + TRUE_IMAGES_FILE, suffix=".build")
+        compress_filename = get_temp_filename(self.batch_dir + "/" + COMPRESS_IMAGES_FILE, suffix=".build")
+        np.lib.format.open_memmap(true_filename, mode="w+", dtype=np.uint8,
+                                  shape=(images_count, window_size, window_size, 1)).flush()
+        if self.compress_input_q > 1:
+            np.lib.format.open_memmap(compress_filename, mode="w+", dtype=np.uint8,
+                                      shape=(images_count, self.batch_image_size, self.batch_image_size, 1)).flush()
+        else:
+            compress_filename = None
+
+        worker_args = [(filename, offset, input_count, true_filename, compress_filename, self.scale,
+                        self.batch_image_size, self.stride, self.channels, self.resampling_method,
+                        self.compress_input_q, selected)
+                       for (filename, offset, input_count), selected in zip(tasks, selections)]
+
+        processed_images = 0
+        pool = multiprocessing.Pool(self.batch_workers) if self.batch_workers > 1 else None
+        try:
+            results = pool.imap_unordered(build_batch_patches_to_store, worker_args) if pool is not None else \
+                map(build_batch_patches_to_store, worker_args)
+            for _ in results:
+                processed_images += 1
+                if processed_images % 10 == 0:
+                    print('.', end='', flush=True)
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+        built_count = images_count
+        if self.patch_filter:
+            true_images = np.load(true_filename, mmap_mode="r+")
+            compress_images_lr = np.load(compress_filename, mmap_mode="r+") if compress_filename is not None else None
+            images_count = self.filter_flat_patches(true_images, compress_images_lr, images_count)
+
+        if images_count < built_count:
+            # kept patches are packed at the head of the temporary store. rewrite only them
+            save_npy_file(self.batch_dir + "/" + TRUE_IMAGES_FILE, true_images[:images_count])
+            del true_images
+            os.remove(true_filename)
+            if compress_filename is not None:
+                save_npy_file(self.batch_dir + "/" + COMPRESS_IMAGES_FILE, compress_images_lr[:images_count])
+                del compress_images_lr
+                os.remove(compress_filename)
+        else:
+            os.replace(true_filename, self.batch_dir + "/" + TRUE_IMAGES_FILE)
+            if compress_filename is not None:
+                os.replace(compress_filename, self.batch_dir + "/" + COMPRESS_IMAGES_FILE)
+
+        elapsed_time = time.time() - start_time
+        logging.info(" ... Finished batch creation.")
+        logging.info(" ... Processed images count: {}".format(processed_images))
+        logging.info(" ... Built {} patches in {:.1f} sec ({:.1f} patches/sec)".format(
+            images_count, elapsed_time, images_count / max(elapsed_time, 1e-6)))
         self.count = images_count
 
         logging.info("%d mini-batch images are built(saved).\n" % images_count)
 
-        #config = configparser.ConfigParser()
-        #config.add_section("batch")
-        #config.set("batch", "count", str(images_count))
-        #config.set("batch", "scale", str(self.scale))
-        #config.set("batch", "batch_image_size", str(self.batch_image_size))
-        #config.set("batch", "stride", str(self.stride))
-        #config.set("batch", "channels", str(self.channels))
-        #
-        #with open(self.batch_dir + "/batch_images.ini", "w") as configfile:
-        #    config.write(configfile)
+        self.write_batch_config()
+        self.load_all_batch_images()
+
+    def save_batch_images(self):
+        """ save built patches as raw .npy files and write the manifest (written last, marks the store complete). """
+
+        util.make_dir(self.batch_dir)
+        if os.path.isfile(self.batch_dir + "/" + BATCH_CONFIG_FILE):
+            os.remove(self.batch_dir + "/" + BATCH_CONFIG_FILE)
+
+        save_npy_file(self.batch_dir + "/" + TRUE_IMAGES_FILE, self.true_images[:self.count])
+        if self.compress_input_q > 1:
+            save_npy_file(self.batch_dir + "/" + COMPRESS_IMAGES_FILE, self.compress_images_lr[:self.count])
+
+        self.write_batch_config()
+
+        # re-open saved patches as memmap so that the private copy is released and page cache is shared
+        self.load_all_batch_images()
+
+    def write_batch_config(self):
+
+        config = configparser.ConfigParser()
+        config.add_section("batch")
+        config.set("batch", "count", str(self.count))
+        config.set("batch", "scale", str(self.scale))
+        config.set("batch", "batch_image_size", str(self.batch_image_size))
+        config.set("batch", "stride", str(self.stride))
+        config.set("batch", "channels", str(self.channels))
+        config.set("batch", "compress_input_q", str(self.compress_input_q))
+        config.set("batch", "resampling_method", self.resampling_method)
+        config.set("batch", "patches_cnt", str(self.patches_cnt))
+        config.set("batch", "patch_memory_mb", str(self.patch_memory_mb))
+        config.set("batch", "patch_filter", self.patch_filter)
+        config.set("batch", "patch_filter_threshold", str(self.patch_filter_threshold))
+        config.set("batch", "flat_patch_keep", str(self.flat_patch_keep))
+        config.set("batch", "store", self.STORE_TYPE)
+
+        temp_filename = get_temp_filename(self.batch_dir + "/" + BATCH_CONFIG_FILE)
+        with open(temp_filename, "w") as configfile:
+            config.write(configfile)
+        os.replace(temp_filename, self.batch_dir + "/" + BATCH_CONFIG_FILE)
+        logging.info("Saved patch store to [%s]" % self.batch_dir)
 
     def load_batch_counts(self):
         """ load already built batch images. """
@@ -221,35 +971,76 @@ class BatchDataSets:
 
         config = configparser.ConfigParser()
         try:
-            with open(self.batch_dir + "/batch_images.ini") as f:
+            with open(self.batch_dir + "/" + BATCH_CONFIG_FILE) as f:
                 config.read_file(f)
             self.count = config.getint("batch", "count")
 
-        except IOError:
+        except (IOError, configparser.Error, ValueError):
             self.count = 0
             return
 
-    #def load_all_batch_images(self):
-    #
-    #    print("Allocating memory for all batch images...")
-    #    # Avoided creating input, bicubic images, as they can be created from true image while training 
-    #    #self.input_images = np.zeros(shape=[self.count, self.batch_image_size, self.batch_image_size, 1],
-    #    #                             dtype=np.uint8)  # type: np.ndarray
-    #    #self.input_interpolated_images = np.zeros(
-    #    #    shape=[self.count, self.batch_image_size * self.scale, self.batch_image_size * self.scale, 1],
-    #    #    dtype=np.uint8)  # type: np.ndarray
-    #    self.true_images = np.zeros(
-    #        shape=[self.count, self.batch_image_size * self.scale, self.batch_image_size * self.scale, 1],
-    #        dtype=np.uint8)  # type: np.ndarray
-    #
-    #    print("Loading all batch images...")
-    #    for i in range(self.count):
-    #        #self.input_images[i] = self.load_input_batch_image(i)
-    #        #self.input_interpolated_images[i] = self.load_interpolated_batch_image(i)
-    #        self.true_images[i] = self.load_true_batch_image(i)
-    #        if i % 1000 == 0:
-    #            print('.', end='', flush=True)
-    #    print("Load finished.")
+    def load_all_batch_images(self):
+        """ open already built patches as read-only memmap. pages are shared by all trainings using same store. """
+
+        self.true_images = np.load(self.batch_dir + "/" + TRUE_IMAGES_FILE, mmap_mode="r")
+        if self.compress_input_q > 1:
+            self.compress_images_lr = np.load(self.batch_dir + "/" + COMPRESS_IMAGES_FILE, mmap_mode="r")
+
+        if self.true_images.shape[0] != self.count:
+            logging.warning("Patch store has %d patches but manifest count is %d" % (self.true_images.shape[0], self.count))
+            self.count = min(self.count, self.true_images.shape[0])
+        logging.info("Loaded %d patches from patch store [%s]" % (self.count, self.batch_dir))
+
+    def get_store_files(self):
+        if self.compress_input_q > 1:
+            return [TRUE_IMAGES_FILE, COMPRESS_IMAGES_FILE]
+        return [TRUE_IMAGES_FILE]
+
+    def get_true_patch(self, number):
+        return self.true_images[number]
+
+    def get_true_patches(self, image_nos, out):
+        """ gather true (HR) patches of image_nos into out (uint8 [N, H, W, 1]). """
+        np.take(self.true_images, image_nos, axis=0, out=out)
+        return out
+
+    def log_stats(self):
+        pass
+
+    def build_input_batch_images(self):
+        """
+        precompute input (LR) and interpolated (bicubic) images for all patches, so load_batch_image() doesn't
+        need any resize while training. costs extra memory for LR and bicubic patches.
+        """
+
+        lr_size = self.batch_image_size
+        hr_size = self.batch_image_size * self.scale
+        input_mem = 0 if self.compress_input_q > 1 else self.count * lr_size * lr_size
+        interpolated_mem = self.count * hr_size * hr_size
+        logging.info("Precomputing input patches: count: {}, input_mem: {:,} bytes, interpolated_mem: {:,} bytes".format(
+            self.count, input_mem, interpolated_mem))
+
+        if self.compress_input_q > 1:
+            input_images = self.compress_images_lr
+        else:
+            input_images = np.zeros(shape=[self.count, lr_size, lr_size, 1], dtype=np.uint8)
+        input_interpolated_images = np.zeros(shape=[self.count, hr_size, hr_size, 1], dtype=np.uint8)
+
+        chunk_patches = 4096
+        true_images = np.empty(shape=[min(chunk_patches, self.count), hr_size, hr_size, 1], dtype=np.uint8)
+        for start in range(0, self.count, chunk_patches):
+            end = min(start + chunk_patches, self.count)
+            if self.compress_input_q <= 1:
+                self.get_true_patches(np.arange(start, end), true_images[:end - start])
+                util.resize_images(true_images[:end - start], 1.0 / self.scale,
+                                   resampling_method=self.resampling_method, out=input_images[start:end])
+            util.resize_images(input_images[start:end], self.scale, resampling_method=self.resampling_method,
+                               out=input_interpolated_images[start:end])
+            print('.', end='', flush=True)
+
+        self.input_images = input_images
+        self.input_interpolated_images = input_interpolated_images
+        logging.info(" ... Finished precomputing input patches.")
 
     def release_batch_images(self):
 
@@ -276,7 +1067,7 @@ class BatchDataSets:
 
         config = configparser.ConfigParser()
         try:
-            with open(self.batch_dir + "/batch_images.ini") as f:
+            with open(self.batch_dir + "/" + BATCH_CONFIG_FILE) as f:
                 config.read_file(f)
 
             if config.getint("batch", "count") <= 0:
@@ -284,32 +1075,55 @@ class BatchDataSets:
 
             if config.getint("batch", "scale") != self.scale:
                 return False
-            # Avoid checking batch size, to allow variable batch sizes
-            #if config.getint("batch", "batch_image_size") != self.batch_image_size:
-            #    return False
-            # Avoid checking stride size
+            if config.getint("batch", "batch_image_size") != self.batch_image_size:
+                return False
             if config.getint("batch", "stride") != self.stride:
                 return False
             if config.getint("batch", "channels") != self.channels:
                 return False
+            if config.getint("batch", "compress_input_q", fallback=0) != self.compress_input_q:
+                return False
+            # LR inputs are stored only for compress_input_q. otherwise they are resized from true patches
+            if self.compress_input_q > 1 and \
+                    config.get("batch", "resampling_method", fallback="bicubic") != self.resampling_method:
+                return False
+            if config.getint("batch", "patches_cnt", fallback=0) != self.patches_cnt:
+                return False
+            if config.getint("batch", "patch_memory_mb", fallback=0) != self.patch_memory_mb:
+                return False
+            if config.get("batch", "patch_filter", fallback="") != self.patch_filter:
+                return False
+            if self.patch_filter and (
+                    config.getfloat("batch", "patch_filter_threshold") != self.patch_filter_threshold or
+                    config.getfloat("batch", "flat_patch_keep") != self.flat_patch_keep):
+                return False
+            if config.get("batch", "store", fallback=BatchDataSets.STORE_TYPE) != self.STORE_TYPE:
+                return False
+
+            for filename in self.get_store_files():
+                if not os.path.isfile(self.batch_dir + "/" + filename):
+                    return False
 
             return True
 
-        except IOError:
+        except (IOError, configparser.Error, ValueError):
             return False
 
-    def init_batch_index(self):
-        self.batch_index = random.sample(range(0, self.count), self.count)
-        self.index = 0
+    def next_true_batch(self, batch_num, image_nos=None):
+        """
+        returns next mini-batch of true (HR) patches only, as uint8 (batch_num, H, W, 1) array. used when input and
+        interpolated images are built in the graph (in_graph_resize). flips commute with the resize, so augmentation
+        is applied to HR patches only.
+        """
 
-    def get_next_image_no(self):
+        if image_nos is None:
+            image_nos = self.get_next_batch_index(batch_num)
+        hr_buffer = self.get_batch_buffers(batch_num).next()[4]
+        self.get_true_patches(image_nos, hr_buffer)
 
-        if self.index >= self.count:
-            self.init_batch_index()
-
-        image_no = self.batch_index[self.index]
-        self.index += 1
-        return image_no
+        if self.augment_level > 1:
+            augment_batch_images((hr_buffer,), self.augment_level)
+        return hr_buffer
 
     def load_batch_image_from_disk(self, image_number):
 
@@ -324,24 +1138,78 @@ class BatchDataSets:
     def load_batch_image(self, max_value):
 
         number = self.get_next_image_no()
-        if max_value == 255:
-            # label (HR) image
-            true_image = self.true_images[number]
-            
+
+        # label (HR) image
+        true_image = self.get_true_patch(number)
+
+        if self.input_images is not None:
+            # precomputed by build_input_batch_images()
+            input_image = self.input_images[number]
+            input_interpolated_image = self.input_interpolated_images[number]
+        else:
             # create input images (LR) from true image
             if self.compress_input_q > 1:
                 input_image = self.compress_images_lr[number]
             else:
                 input_image = util.resize_image_by_pil(true_image, 1.0 / self.scale, resampling_method=self.resampling_method)
-                
+
             # interpolate input for skip connection
-            input_interpolated_image = util.resize_image_by_pil(input_image, self.scale, resampling_method=self.resampling_method)        
+            input_interpolated_image = util.resize_image_by_pil(input_image, self.scale, resampling_method=self.resampling_method)
+
+        if self.augment_level > 1:
+            flip_type = random.randrange(self.augment_level)
+            input_image = util.flip(input_image, flip_type)
+            input_interpolated_image = util.flip(input_interpolated_image, flip_type)
+            true_image = util.flip(true_image, flip_type)
+
+        if max_value == 255:
             return input_image, input_interpolated_image, true_image
         else:
             scale = max_value / 255.0
-            return np.multiply(self.input_images[number], scale), \
-                np.multiply(self.input_interpolated_images[number], scale), \
-                np.multiply(self.true_images[number], scale)
+            return np.multiply(input_image, scale), \
+                np.multiply(input_interpolated_image, scale), \
+                np.multiply(true_image, scale)
+
+    def get_batch_images(self, image_nos, max_value, out=None):
+        """ gather patches of image_nos into (input, interpolated, true) batch arrays. """
+
+        if out is None:
+            out = BatchBuffers(len(image_nos), self.batch_image_size, self.batch_image_size * self.scale,
+                               count=1).next()
+        input_batch, input_interpolated_batch, true_batch, lr_buffer, hr_buffer = out
+
+        # label (HR) images
+        self.get_true_patches(image_nos, hr_buffer)
+        np.copyto(true_batch, hr_buffer)
+
+        if self.input_images is not None:
+            # precomputed by build_input_batch_images()
+            np.take(self.input_images, image_nos, axis=0, out=lr_buffer)
+            np.copyto(input_batch, lr_buffer)
+            np.take(self.input_interpolated_images, image_nos, axis=0, out=hr_buffer)
+            np.copyto(input_interpolated_batch, hr_buffer)
+        else:
+            if self.compress_input_q > 1:
+                np.take(self.compress_images_lr, image_nos, axis=0, out=lr_buffer)
+            else:
+                util.resize_images(hr_buffer, 1.0 / self.scale, resampling_method=self.resampling_method,
+                                   out=lr_buffer)
+            np.copyto(input_batch, lr_buffer)
+
+            # interpolate input for skip connection
+            util.resize_images(lr_buffer, self.scale, resampling_method=self.resampling_method,
+                               out=input_interpolated_batch)
+
+        if self.augment_level > 1:
+            augment_batch_images((input_batch, input_interpolated_batch, true_batch), self.augment_level)
+
+        if max_value != 255:
+            scale = max_value / 255.0
+            np.multiply(input_batch, scale, out=input_batch)
+            np.multiply(input_interpolated_batch, scale, out=input_interpolated_batch)
+            np.multiply(true_batch, scale, out=true_batch)
+
+        return input_batch, input_interpolated_batch, true_batch
 
     def load_input_batch_image(self, image_number):
         image = misc.imread(self.batch_dir + "/" + INPUT_IMAGE_DIR + "/%06d.bmp" % image_number)
@@ -365,8 +1233,539 @@ class BatchDataSets:
         return util.save_image(self.batch_dir + "/" + TRUE_IMAGE_DIR + "/%06d.bmp" % image_number, image)
 
 
-class DynamicDataSets:
-    def __init__(self, scale, batch_image_size, channels=1, resampling_method="bicubic"):
+class PatchAtlasDataSets(BatchDataSets):
+    """
+    Batch datasets which keep each aligned Y image only once in a contiguous memmapped atlas.
+    Patches are (image_id, y, x) offsets in an int32 index and are sliced from the atlas when they are loaded,
+    so grid patches overlapping with stride < patch size don't store the same pixels several times.
+    Compressed inputs (compress_input_q) are not supported.
+    """
+    STORE_TYPE = "atlas"
+
+    def __init__(self, scale, batch_dir, batch_image_size, stride_size=0, channels=1, resampling_method="bicubic",
+                 patches_cnt=0, augment_level=1):
+
+        super().__init__(scale, batch_dir, batch_image_size, stride_size=stride_size, channels=channels,
+                         resampling_method=resampling_method, patches_cnt=patches_cnt, augment_level=augment_level)
+        self.atlas = None
+        self.atlas_images = None
+        self.patch_index = None
+
+    def build_batch(self, data_dir):
+        """ Build image atlas and patch index. """
+
+        print("Building image atlas for %s..." % self.batch_dir)
+        self.check_image_shards(data_dir)
+        filenames = get_image_files(data_dir)
+        start_time = time.time()
+
+        tasks, patches_cnt = self.get_batch_tasks(filenames)
+        image_sizes = self.get_image_sizes([filename for filename, offset, input_count in tasks])
+        window_size = self.batch_image_size * self.scale
+        window_stride = self.stride * self.scale
+
+        # [offset, height, width] of each aligned image in the atlas
+        atlas_images = np.zeros(shape=[len(tasks), 3], dtype=np.int64)
+        atlas_size = 0
+        for i, (filename, offset, input_count) in enumerate(tasks):
+            width, height = image_sizes[filename]
+            height = (height // self.scale) * self.scale
+            width = (width // self.scale) * self.scale
+            atlas_images[i] = [atlas_size, height, width]
+            atlas_size += height * width
+
+        logging.info("Atlas: {} images, {:,} bytes. (patch store would need {:,} bytes)".format(
+            len(tasks), atlas_size, patches_cnt * window_size * window_size))
+
+        util.make_dir(self.batch_dir)
+        if os.path.isfile(self.batch_dir + "/" + BATCH_CONFIG_FILE):
+            os.remove(self.batch_dir + "/" + BATCH_CONFIG_FILE)
+
+        atlas_filename = get_temp_filename(self.batch_dir + "/" + ATLAS_FILE)
+        atlas = np.lib.format.open_memmap(atlas_filename, mode="w+", dtype=np.uint8, shape=(atlas_size,))
+        patch_index = np.zeros(shape=[patches_cnt, 3], dtype=np.int32)
+
+        processed_images = 0
+        for i, (filename, offset, input_count) in enumerate(tasks):
+            input_image, input_interpolated_image, true_image = \
+                build_image_set(filename, channels=self.channels, resampling_method=self.resampling_method,
+                                scale=self.scale, print_console=False)
+            image_offset, height, width = atlas_images[i]
+            if true_image.shape[0] != height or true_image.shape[1] != width:
+                raise util.LoadError("Unexpected image size of [%s]" % filename)
+            atlas[image_offset:image_offset + height * width] = true_image.astype(np.uint8).reshape(height * width)
+
+            # grid positions in the same order as util.get_split_images()
+            ys, xs = np.meshgrid(np.arange(0, height - window_size + 1, window_stride),
+                                 np.arange(0, width - window_size + 1, window_stride), indexing="ij")
+            patch_index[offset:offset + input_count, 0] = i
+            patch_index[offset:offset + input_count, 1] = ys.reshape(-1)
+            patch_index[offset:offset + input_count, 2] = xs.reshape(-1)
+
+            processed_images += 1
+            if processed_images % 10 == 0:
+                print('.', end='', flush=True)
+
+        atlas.flush()
+        del atlas
+        os.replace(atlas_filename, self.batch_dir + "/" + ATLAS_FILE)
+        save_npy_file(self.batch_dir + "/" + ATLAS_IMAGES_FILE, atlas_images)
+        save_npy_file(self.batch_dir + "/" + ATLAS_PATCHES_FILE, patch_index)
+
+        elapsed_time = time.time() - start_time
+        logging.info(" ... Finished atlas creation.")
+        logging.info(" ... Processed images count: {}".format(processed_images))
+        logging.info(" ... Indexed {} patches in {:.1f} sec".format(patches_cnt, elapsed_time))
+        self.count = patches_cnt
+
+        self.write_batch_config()
+        self.load_all_batch_images()
+
+    def get_store_files(self):
+        return [ATLAS_FILE, ATLAS_IMAGES_FILE, ATLAS_PATCHES_FILE]
+
+    def load_all_batch_images(self):
+        """ open atlas as read-only memmap. image table and patch index are small and loaded in memory. """
+
+        self.atlas = np.load(self.batch_dir + "/" + ATLAS_FILE, mmap_mode="r")
+        self.atlas_images = np.load(self.batch_dir + "/" + ATLAS_IMAGES_FILE)
+        self.patch_index = np.load(self.batch_dir + "/" + ATLAS_PATCHES_FILE)
+
+        if self.patch_index.shape[0] != self.count:
+            logging.warning("Patch index has %d patches but manifest count is %d" % (self.patch_index.shape[0], self.count))
+            self.count = min(self.count, self.patch_index.shape[0])
+        logging.info("Loaded %d patches of %d images from atlas [%s]" % (self.count, self.atlas_images.shape[0],
+                                                                          self.batch_dir))
+
+    def release_batch_images(self):
+        super().release_batch_images()
+        self.atlas = None
+        self.atlas_images = None
+        self.patch_index = None
+
+    def get_true_patch(self, number):
+        return self.get_atlas_patch(*self.patch_index[number])
+
+    def get_true_patches(self, image_nos, out):
+        return self.gather_atlas_patches(self.patch_index[image_nos], out)
+
+    def get_atlas_patch(self, image_id, y, x):
+        """ returns a view of the patch in the atlas. """
+
+        image_offset, height, width = self.atlas_images[image_id]
+        window_size = self.batch_image_size * self.scale
+
+        image = self.atlas[image_offset:image_offset + height * width].reshape(height, width, 1)
+        return image[y:y + window_size, x:x + window_size]
+
+    def gather_atlas_patches(self, patches, out):
+        """ gather patches of [N, 3] (image_id, y, x) array from the atlas into out with one vectorized take. """
+
+        window = np.arange(self.batch_image_size * self.scale)
+        images = self.atlas_images[patches[:, 0]]
+        widths = images[:, 2]
+
+        starts = images[:, 0] + patches[:, 1] * widths + patches[:, 2]
+        indices = starts[:, None, None] + window[None, :, None] * widths[:, None, None] + window[None, None, :]
+        np.take(self.atlas, indices, out=out.reshape(indices.shape))
+        return out
+
+
+class RandomCropDataSets(PatchAtlasDataSets):
+    """
+    Batch datasets which keep the decoded Y atlas in RAM and crop every patch at a random pixel offset instead of
+    on the stride grid. Offsets are drawn uniformly over all valid crop positions of all images, so bigger images
+    are sampled more often, just like the grid. Uses the same atlas files as PatchAtlasDataSets.
+    Epoch length (count) is the number of grid patches.
+    """
+    RANDOM_PATCHES = True
+
+    def __init__(self, scale, batch_dir, batch_image_size, stride_size=0, channels=1, resampling_method="bicubic",
+                 patches_cnt=0, augment_level=1):
+
+        super().__init__(scale, batch_dir, batch_image_size, stride_size=stride_size, channels=channels,
+                         resampling_method=resampling_method, patches_cnt=patches_cnt, augment_level=augment_level)
+        self.crop_positions = None
+        self.crop_starts = None
+        self.crop_widths = None
+
+    def load_all_batch_images(self):
+        """ load whole atlas into memory and build cumulative count of crop positions per image. """
+
+        super().load_all_batch_images()
+        self.atlas = np.load(self.batch_dir + "/" + ATLAS_FILE)
+
+        window_size = self.batch_image_size * self.scale
+        heights = np.maximum(self.atlas_images[:, 1] - window_size + 1, 0)
+        self.crop_widths = np.maximum(self.atlas_images[:, 2] - window_size + 1, 0)
+        self.crop_positions = np.cumsum(heights * self.crop_widths)
+        self.crop_starts = self.crop_positions - heights * self.crop_widths
+        logging.info("Random crop: %d possible patch positions in %d images (%d grid patches)" % (
+            self.crop_positions[-1], self.atlas_images.shape[0], self.count))
+
+    def release_batch_images(self):
+        super().release_batch_images()
+        self.crop_positions = None
+        self.crop_starts = None
+        self.crop_widths = None
+
+    def build_input_batch_images(self):
+        logging.warning("precompute_input is ignored since patches are cropped at random offsets.")
+
+    def get_random_crops(self, count):
+        """ returns [count, 3] array of random (image_id, y, x). """
+
+        positions = np.random.randint(self.crop_positions[-1], size=count)
+        image_ids = np.searchsorted(self.crop_positions, positions, side="right")
+        positions -= self.crop_starts[image_ids]
+        crop_widths = self.crop_widths[image_ids]
+
+        return np.stack([image_ids, positions // crop_widths, positions % crop_widths], axis=1)
+
+    def get_true_patch(self, number):
+        """ number is not used. returns a view of a random crop. """
+        return self.get_atlas_patch(*self.get_random_crops(1)[0])
+
+    def get_true_patches(self, image_nos, out):
+        """ image_nos are only used as the batch size. """
+        return self.gather_atlas_patches(self.get_random_crops(len(image_nos)), out)
+
+
+class ShardedBatchDataSets(BatchDataSets):
+    """
+    Batch datasets for patch sets which don't fit in memory. Patches are saved in shards of about shard_mb and
+    streamed from disk one whole shard at a time (shards in random order on each pass, patches of a shard in random
+    order) into a shuffle buffer. Mini-batches take random patches of the buffer, which are replaced by the next
+    patches of the stream. Only the shuffle buffer and one shard are resident.
+    Compressed inputs (compress_input_q) and precompute_input are not supported.
+    """
+    STORE_TYPE = "shards"
+    RANDOM_PATCHES = True
+
+    def __init__(self, scale, batch_dir, batch_image_size, stride_size=0, channels=1, resampling_method="bicubic",
+                 patches_cnt=0, augment_level=1, shard_mb=256, shuffle_buffer_mb=256):
+
+        super().__init__(scale, batch_dir, batch_image_size, stride_size=stride_size, channels=channels,
+                         resampling_method=resampling_method, patches_cnt=patches_cnt, augment_level=augment_level)
+
+        patch_bytes = (batch_image_size * scale) ** 2
+        self.shard_patches = max(1, shard_mb * 1024 * 1024 // patch_bytes)
+        self.shuffle_buffer_patches = max(1, shuffle_buffer_mb * 1024 * 1024 // patch_bytes)
+        self.shard_sizes = None
+
+        self.shuffle_buffer = None
+        self.shard = None
+        self.shard_order = None
+        self.shard_order_index = 0
+        self.shard_patch_order = None
+        self.shard_position = 0
+        self.stream_lock = threading.Lock()
+
+        self.read_shards = 0
+        self.read_bytes = 0
+        self.read_time = 0.0
+
+    def build_batch(self, data_dir):
+        """ Build patch shards. Patches are written to shard memmaps image by image, so memory use is one image. """
+
+        print("Building patch shards for %s..." % self.batch_dir)
+        self.check_image_shards(data_dir)
+        filenames = get_image_files(data_dir)
+        start_time = time.time()
+
+        tasks, patches_cnt = self.get_batch_tasks(filenames)
+        shard_sizes = np.array([min(self.shard_patches, patches_cnt - i)
+                                for i in range(0, patches_cnt, self.shard_patches)], dtype=np.int64)
+        logging.info("Writing %d patches into %d shards of %d patches" % (patches_cnt, len(shard_sizes),
+                                                                          self.shard_patches))
+
+        util.make_dir(self.batch_dir)
+        if os.path.isfile(self.batch_dir + "/" + BATCH_CONFIG_FILE):
+            os.remove(self.batch_dir + "/" + BATCH_CONFIG_FILE)
+
+        window_size = self.batch_image_size * self.scale
+        shard = None
+        shard_no = -1
+        processed_images = 0
+        for filename, offset, input_count in tasks:
+            true_batch_images, compress_batch_images = build_batch_patches(
+                filename, self.scale, self.batch_image_size, self.stride, channels=self.channels,
+                resampling_method=self.resampling_method)
+            if true_batch_images is None or true_batch_images.shape[0] != input_count:
+                raise util.LoadError("Unexpected patch count from [%s]" % filename)
+
+            # patches of an image may continue in the next shard
+            written = 0
+            while written < input_count:
+                position = offset + written
+                if position // self.shard_patches != shard_no:
+                    self.close_shard_file(shard, shard_no)
+                    shard_no = position // self.shard_patches
+                    shard = np.lib.format.open_memmap(get_temp_filename(self.get_shard_filename(shard_no)), mode="w+",
+                                                      dtype=np.uint8,
+                                                      shape=(int(shard_sizes[shard_no]), window_size, window_size, 1))
+                shard_position = position - shard_no * self.shard_patches
+                count = min(input_count - written, shard_sizes[shard_no] - shard_position)
+                shard[shard_position:shard_position + count] = true_batch_images[written:written + count]
+                written += count
+
+            processed_images += 1
+            if processed_images % 10 == 0:
+                print('.', end='', flush=True)
+
+        self.close_shard_file(shard, shard_no)
+        save_npy_file(self.batch_dir + "/" + PATCH_SHARDS_FILE, shard_sizes)
+
+        elapsed_time = time.time() - start_time
+        logging.info(" ... Finished patch shards creation.")
+        logging.info(" ... Processed images count: {}".format(processed_images))
+        logging.info(" ... Built {} patches in {:.1f} sec ({:.1f} patches/sec)".format(
+            patches_cnt, elapsed_time, patches_cnt / max(elapsed_time, 1e-6)))
+        self.count = patches_cnt
+
+        self.write_batch_config()
+        self.load_all_batch_images()
+
+    def get_shard_filename(self, shard_no):
+        return self.batch_dir + "/" + PATCH_SHARD_FILE % shard_no
+
+    def close_shard_file(self, shard, shard_no):
+        if shard is None:
+            return
+        shard.flush()
+        del shard
+        os.replace(get_temp_filename(self.get_shard_filename(shard_no)), self.get_shard_filename(shard_no))
+
+    def get_store_files(self):
+        return [PATCH_SHARDS_FILE]
+
+    def is_batch_exist(self):
+
+        if not super().is_batch_exist():
+            return False
+        try:
+            shard_sizes = np.load(self.batch_dir + "/" + PATCH_SHARDS_FILE)
+        except (IOError, ValueError):
+            return False
+        return all(os.path.isfile(self.get_shard_filename(shard_no)) for shard_no in range(len(shard_sizes)))
+
+    def load_all_batch_images(self):
+        """ only shard sizes are loaded. patches are streamed when mini-batches are built. """
+
+        self.release_batch_images()
+        self.shard_sizes = np.load(self.batch_dir + "/" + PATCH_SHARDS_FILE)
+        if int(self.shard_sizes.sum()) != self.count:
+            logging.warning("Patch shards have %d patches but manifest count is %d" % (self.shard_sizes.sum(),
+                                                                                      self.count))
+            self.count = int(self.shard_sizes.sum())
+        logging.info("Opened %d patches in %d shards [%s]. shuffle buffer: %d patches" % (
+            self.count, len(self.shard_sizes), self.batch_dir, min(self.shuffle_buffer_patches, self.count)))
+
+    def release_batch_images(self):
+        super().release_batch_images()
+        self.shuffle_buffer = None
+        self.shard = None
+        self.shard_order = None
+
+    def build_input_batch_images(self):
+        logging.warning("precompute_input is ignored since patches are streamed from shards.")
+
+    def read_next_shard(self):
+
+        if self.shard_order is None or self.shard_order_index >= len(self.shard_sizes):
+            self.shard_order = np.random.permutation(len(self.shard_sizes))
+            self.shard_order_index = 0
+        shard_no = self.shard_order[self.shard_order_index]
+        self.shard_order_index += 1
+
+        # whole shard is read sequentially
+        start_time = time.time()
+        self.shard = None
+        self.shard = np.load(self.get_shard_filename(shard_no))
+        self.read_time += time.time() - start_time
+        self.read_bytes += self.shard.nbytes
+        self.read_shards += 1
+
+        self.shard_patch_order = np.random.permutation(self.shard.shape[0])
+        self.shard_position = 0
+
+    def read_patches(self, out):
+        """ fill out with next patches of the shard stream. """
+
+        filled = 0
+        while filled < out.shape[0]:
+            if self.shard is None or self.shard_position >= self.shard.shape[0]:
+                self.read_next_shard()
+            count = min(out.shape[0] - filled, self.shard.shape[0] - self.shard_position)
+            np.take(self.shard, self.shard_patch_order[self.shard_position:self.shard_position + count], axis=0,
+                    out=out[filled:filled + count])
+            self.shard_position += count
+            filled += count
+
+    def get_true_patches(self, image_nos, out):
+        """ image_nos are only used as the batch size. takes random patches of the shuffle buffer and refills them. """
+
+        batch_num = len(image_nos)
+        with self.stream_lock:
+            if self.shuffle_buffer is None:
+                window_size = self.batch_image_size * self.scale
+                buffer_size = min(max(self.shuffle_buffer_patches, batch_num), self.count)
+                self.shuffle_buffer = np.empty(shape=[buffer_size, window_size, window_size, 1], dtype=np.uint8)
+                self.read_patches(self.shuffle_buffer)
+
+            buffer_size = self.shuffle_buffer.shape[0]
+            slots = np.random.choice(buffer_size, batch_num, replace=batch_num > buffer_size)
+            np.take(self.shuffle_buffer, slots, axis=0, out=out)
+            refill = np.empty_like(out)
+            self.read_patches(refill)
+            self.shuffle_buffer[slots] = refill
+
+        return out
+
+    def get_true_patch(self, number):
+        """ number is not used. """
+
+        window_size = self.batch_image_size * self.scale
+        out = np.empty(shape=[1, window_size, window_size, 1], dtype=np.uint8)
+        return self.get_true_patches([number], out)[0]
+
+    def log_stats(self):
+        if self.read_shards > 0:
+            logging.info("Patch shards: read %d shards, %.1f MB in %.2f sec (%.1f MB/sec)" % (
+                self.read_shards, self.read_bytes / 1024 / 1024, self.read_time,
+                self.read_bytes / 1024 / 1024 / max(self.read_time, 1e-6)))
+        self.read_shards = 0
+        self.read_bytes = 0
+        self.read_time = 0.0
+
+
+class CompressedBatchDataSets(BatchDataSets):
+    """
+    Batch datasets which keep true (HR) patches in memory compressed losslessly in blocks of block_patches patches
+    (horizontal delta filter + zlib). Decompressed blocks are kept in a small LRU cache. Batch index visits
+    cache_blocks blocks at a time (patches shuffled among them), so each block is decompressed about once per epoch.
+    Uses the same patch store files as BatchDataSets. They are built through memmap, so the uncompressed store is
+    never held in memory.
+    """
+
+    BUILD_TO_STORE_FILES = True
+
+    def __init__(self, scale, batch_dir, batch_image_size, stride_size=0, channels=1, resampling_method="bicubic",
+                 patches_cnt=0, compress_input_q=0, batch_workers=0, augment_level=1, patch_memory_mb=0,
+                 patch_filter="", patch_filter_threshold=0, flat_patch_keep=0, block_patches=256, cache_blocks=16,
+                 compress_level=1):
+
+        super().__init__(scale, batch_dir, batch_image_size, stride_size=stride_size, channels=channels,
+                         resampling_method=resampling_method, patches_cnt=patches_cnt,
+                         compress_input_q=compress_input_q, batch_workers=batch_workers, augment_level=augment_level,
+                         patch_memory_mb=patch_memory_mb, patch_filter=patch_filter,
+                         patch_filter_threshold=patch_filter_threshold, flat_patch_keep=flat_patch_keep)
+
+        self.block_patches = block_patches
+        self.cache_blocks = max(cache_blocks, 1)
+        self.compress_level = compress_level
+        self.blocks = None
+        self.block_cache = collections.OrderedDict()
+        self.block_lock = threading.Lock()
+
+        self.decompressed_blocks = 0
+        self.decompress_time = 0.0
+        self.gathered_batches = 0
+
+    def load_all_batch_images(self):
+        """ compress patches of the store block by block. the memmap is released after that. """
+
+        super().load_all_batch_images()
+
+        start_time = time.time()
+        self.blocks = []
+        for start in range(0, self.count, self.block_patches):
+            block = np.array(self.true_images[start:min(start + self.block_patches, self.count)])
+            # delta of horizontal neighbors (mod 256) is smaller and compresses better than the pixels
+            block[:, :, 1:] = np.diff(block, axis=2)
+            self.blocks.append(zlib.compress(block.tobytes(), self.compress_level))
+        self.true_images = None
+        self.block_cache.clear()
+
+        window_size = self.batch_image_size * self.scale
+        raw_bytes = self.count * window_size * window_size
+        compressed_bytes = sum(len(block) for block in self.blocks)
+        logging.info("Compressed %d patches in %d blocks: %.1f MB -> %.1f MB (%.2fx) in %.1f sec" % (
+            self.count, len(self.blocks), raw_bytes / 1024 / 1024, compressed_bytes / 1024 / 1024,
+            raw_bytes / max(compressed_bytes, 1), time.time() - start_time))
+
+    def release_batch_images(self):
+        super().release_batch_images()
+        self.blocks = None
+        self.block_cache.clear()
+
+    def get_block(self, block_no):
+
+        with self.block_lock:
+            block = self.block_cache.get(block_no)
+            if block is not None:
+                self.block_cache.move_to_end(block_no)
+                return block
+
+        start_time = time.time()
+        window_size = self.batch_image_size * self.scale
+        block = np.frombuffer(zlib.decompress(self.blocks[block_no]), dtype=np.uint8)
+        block = np.cumsum(block.reshape(-1, window_size, window_size, 1), axis=2, dtype=np.uint8)
+
+        with self.block_lock:
+            self.decompressed_blocks += 1
+            self.decompress_time += time.time() - start_time
+            self.block_cache[block_no] = block
+            while len(self.block_cache) > self.cache_blocks:
+                self.block_cache.popitem(last=False)
+        return block
+
+    def init_batch_index(self):
+        """ shuffle blocks, then shuffle patches within each group of cache_blocks blocks. """
+
+        block_order = np.random.permutation(len(self.blocks))
+        self.batch_index = np.empty(self.count, dtype=np.int64)
+        index = 0
+        for i in range(0, len(block_order), self.cache_blocks):
+            image_nos = np.concatenate([np.arange(block_no * self.block_patches,
+                                                  min((block_no + 1) * self.block_patches, self.count))
+                                        for block_no in block_order[i:i + self.cache_blocks]])
+            self.batch_index[index:index + len(image_nos)] = np.random.permutation(image_nos)
+            index += len(image_nos)
+        self.index = 0
+
+    def get_true_patch(self, number):
+        return self.get_block(number // self.block_patches)[number % self.block_patches]
+
+    def get_true_patches(self, image_nos, out):
+
+        image_nos = np.asarray(image_nos)
+        block_nos = image_nos // self.block_patches
+        for block_no in np.unique(block_nos):
+            i = np.flatnonzero(block_nos == block_no)
+            out[i] = self.get_block(block_no)[image_nos[i] % self.block_patches]
+        with self.block_lock:
+            self.gathered_batches += 1
+        return out
+
+    def log_stats(self):
+
+        with self.block_lock:
+            if self.gathered_batches > 0:
+                logging.info("Compressed patches: decompressed %d blocks in %.2f sec (%.2f ms per mini-batch)" % (
+                    self.decompressed_blocks, self.decompress_time,
+                    1000 * self.decompress_time / self.gathered_batches))
+            self.decompressed_blocks = 0
+            self.decompress_time = 0.0
+            self.gathered_batches = 0
+
+
+class DynamicDataSets(BatchIndexMixin):
+    # patches are cropped at random from image files, so they have no stable patch number
+    RANDOM_PATCHES = True
+
+    def __init__(self, scale, batch_image_size, channels=1, resampling_method="bicubic", image_cache_mb=0,
+                 image_cache_dir="", patches_per_image=1, augment_level=1):
 
         self.scale = scale
         self.batch_image_size = batch_image_size
@@ -376,70 +1775,506 @@ class DynamicDataSets:
         self.filenames = []
         self.count = 0
         self.batch_index = None
+        self.batch_buffer_count = 2
+        self.batch_buffers = None
+
+        if image_cache_mb > 0:
+            self.image_cache = ImageCache(image_cache_mb * 1024 * 1024, cache_dir=image_cache_dir)
+        else:
+            self.image_cache = None
+
+        # patches_per_image > 1: draw several crops from each decoded image through a shuffled patch pool
+        self.patches_per_image = max(patches_per_image, 1)
+        self.patch_pool = []
+        self.patch_pool_size = self.patches_per_image * PATCH_POOL_IMAGES
+        self.pool_file_index = None
+        self.pool_index = 0
+        self.pool_lock = threading.Lock()
+
+        # augment_level <= 1 keeps the random fliplr of each patch. 2-8 uses random util.flip() types per mini-batch
+        self.augment_level = augment_level
        
     def set_data_dir(self, data_dir):
-        self.filenames = util.get_files_in_directory(data_dir)
+        self.filenames = get_image_files(data_dir)
         self.count = len(self.filenames)
         if self.count <= 0:
             logging.error("Data Directory is empty.")
             exit(-1)
+        self.pool_index = self.count
 
-    def init_batch_index(self):
-        self.batch_index = random.sample(range(0, self.count), self.count)
-        self.index = 0
+    def load_batch_image(self, max_value):
 
-    def get_next_image_no(self):
+        """ index won't be used. """
 
-        if self.index >= self.count:
-            self.init_batch_index()
+        input_image, input_bicubic_image, image = self.build_batch_image(self.get_next_image_no())
 
-        image_no = self.batch_index[self.index]
-        self.index += 1
-        return image_no
+        if self.augment_level > 1:
+            flip_type = random.randrange(self.augment_level)
+            input_image = util.flip(input_image, flip_type)
+            input_bicubic_image = util.flip(input_bicubic_image, flip_type)
+            image = util.flip(image, flip_type)
 
-    def load_batch_image(self, max_value):
+        if max_value != 255:
+            scale = max_value / 255.0
+            input_image = np.multiply(input_image, scale)
+            input_bicubic_image = np.multiply(input_bicubic_image, scale)
+            image = np.multiply(image, scale)
 
-        """ index won't be used. """
+        return input_image, input_bicubic_image, image
+
+    def build_true_image(self, image_no):
 
-        image = None
-        while image is None:
-            image = self.load_random_patch(self.filenames[self.get_next_image_no()])
+        if self.patches_per_image > 1:
+            image = self.get_pooled_patch()
+        else:
+            image = self.load_random_patch(self.filenames[image_no])
+            while image is None:
+                image = self.load_random_patch(self.filenames[self.get_next_image_no()])
 
-        if random.randrange(2) == 0:
+        if self.augment_level <= 1 and random.randrange(2) == 0:
             image = np.fliplr(image)
 
+        return image
+
+    def build_batch_image(self, image_no):
+
+        image = self.build_true_image(image_no)
         input_image = util.resize_image_by_pil(image, 1 / self.scale)
         input_bicubic_image = util.resize_image_by_pil(input_image, self.scale)
 
+        return input_image, input_bicubic_image, image
+
+    def get_batch_images(self, image_nos, max_value, out=None):
+        """ load random patches of image_nos files into (input, bicubic, true) batch arrays. """
+
+        if out is None:
+            out = BatchBuffers(len(image_nos), self.batch_image_size, self.batch_image_size * self.scale,
+                               count=1).next()
+        input_batch, input_bicubic_batch, true_batch = out[:3]
+
+        # patches keep their loaded dtype, so resizing them at once gives the same result as per patch
+        true_images = np.stack([self.build_true_image(image_no) for image_no in image_nos])
+        input_images = util.resize_images(true_images, 1 / self.scale)
+        np.copyto(true_batch, true_images)
+        np.copyto(input_batch, input_images)
+        util.resize_images(input_images, self.scale, out=input_bicubic_batch)
+
+        if self.augment_level > 1:
+            augment_batch_images((input_batch, input_bicubic_batch, true_batch), self.augment_level)
+
         if max_value != 255:
             scale = max_value / 255.0
-            input_image = np.multiply(input_image, scale)
-            input_bicubic_image = np.multiply(input_bicubic_image, scale)
-            image = np.multiply(image, scale)
+            np.multiply(input_batch, scale, out=input_batch)
+            np.multiply(input_bicubic_batch, scale, out=input_bicubic_batch)
+            np.multiply(true_batch, scale, out=true_batch)
 
-        return input_image, input_bicubic_image, image
+        return input_batch, input_bicubic_batch, true_batch
 
-    def load_random_patch(self, filename):
+    def log_stats(self):
+        if self.image_cache is not None:
+            self.image_cache.log_stats()
+
+    def load_converted_image(self, filename):
+        """ load whole image converted to Y (channels=1). float Y is kept as float32 to halve cache memory. """
 
         image = util.load_image(filename, print_console=False)
+        image = build_input_image(image, channels=self.channels, convert_ycbcr=True)
+        if image.dtype == np.float64:
+            image = image.astype(np.float32)
+        return image
+
+    def load_random_patch(self, filename):
+
+        patches = self.load_random_patches(filename, 1)
+        return patches[0] if patches else None
+
+    def load_random_patches(self, filename, count):
+        """ decode image once and returns list of count random patches. empty list if image is too small. """
+
+        shards = get_image_shards(os.path.dirname(filename))
+        if shards is not None:
+            # packed Y plane, already memmapped
+            image = shards.load_image(filename)
+        elif self.image_cache is not None:
+            image = self.image_cache.get(filename, self.load_converted_image, suffix="_c%d" % self.channels)
+        else:
+            image = util.load_image(filename, print_console=False)
         height, width = image.shape[0:2]
 
         load_batch_size = self.batch_image_size * self.scale
 
         if height < load_batch_size or width < load_batch_size:
             print("Error: %s should have more than %d x %d size." % (filename, load_batch_size, load_batch_size))
-            return None
+            return []
 
-        if height == load_batch_size:
-            y = 0
-        else:
-            y = random.randrange(height - load_batch_size)
+        patches = []
+        for _ in range(count):
+            if height == load_batch_size:
+                y = 0
+            else:
+                y = random.randrange(height - load_batch_size)
 
-        if width == load_batch_size:
-            x = 0
-        else:
-            x = random.randrange(width - load_batch_size)
-        image = image[y:y + load_batch_size, x:x + load_batch_size, :]
-        image = build_input_image(image, channels=self.channels, convert_ycbcr=True)
+            if width == load_batch_size:
+                x = 0
+            else:
+                x = random.randrange(width - load_batch_size)
+            patch = image[y:y + load_batch_size, x:x + load_batch_size, :]
+            if self.image_cache is None and shards is None:
+                patch = build_input_image(patch, channels=self.channels, convert_ycbcr=True)
+            patches.append(patch)
+
+        return patches
+
+    def get_pooled_patch(self):
+        """
+        draw a random patch from the patch pool. The pool is refilled with patches_per_image crops per decoded
+        image (in its own file order), so crops of one image are spread over many upcoming mini-batches.
+        """
+
+        with self.pool_lock:
+            while len(self.patch_pool) < self.patch_pool_size:
+                if self.pool_index >= self.count:
+                    self.pool_file_index = np.random.permutation(self.count)
+                    self.pool_index = 0
+                filename = self.filenames[self.pool_file_index[self.pool_index]]
+                self.pool_index += 1
+                self.patch_pool.extend(self.load_random_patches(filename, self.patches_per_image))
+
+            i = random.randrange(len(self.patch_pool))
+            self.patch_pool[i], self.patch_pool[-1] = self.patch_pool[-1], self.patch_pool[i]
+            return self.patch_pool.pop()
+
+
+class ShardWriter:
+    """
+    Packs uint8 Y images into flat .npy shards of about shard_bytes each, and writes SHARD_INDEX_FILE with the shard
+    and offset of each image. The index is written last, so a directory with an index has complete shards.
+    """
+
+    def __init__(self, shard_dir, shard_bytes=256 * 1024 * 1024):
+
+        self.shard_dir = shard_dir
+        self.shard_bytes = shard_bytes
+        self.shards = []
+        self.images = []
+        self.buffer = []
+        self.buffer_bytes = 0
+
+        util.make_dir(shard_dir)
+        if os.path.isfile(shard_dir + "/" + SHARD_INDEX_FILE):
+            os.remove(shard_dir + "/" + SHARD_INDEX_FILE)
+
+    def add(self, name, image):
+        """ add [H, W] or [H, W, 1] uint8 image. """
+
+        height, width = image.shape[0:2]
+        self.images.append([name, len(self.shards), self.buffer_bytes, height, width])
+        self.buffer.append(np.ascontiguousarray(image, dtype=np.uint8).reshape(height * width))
+        self.buffer_bytes += height * width
+
+        if self.buffer_bytes >= self.shard_bytes:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+
+        shard_filename = "shard_%05d.npy" % len(self.shards)
+        save_npy_file(self.shard_dir + "/" + shard_filename, np.concatenate(self.buffer))
+        self.shards.append(shard_filename)
+        self.buffer = []
+        self.buffer_bytes = 0
+
+    def close(self):
+        self.flush()
+
+        index = {"channels": 1, "shards": self.shards, "images": self.images}
+        with open(self.shard_dir + "/" + SHARD_INDEX_FILE + ".tmp", "w") as f:
+            json.dump(index, f)
+        os.replace(self.shard_dir + "/" + SHARD_INDEX_FILE + ".tmp", self.shard_dir + "/" + SHARD_INDEX_FILE)
+        logging.info("Packed %d images into %d shards in [%s]" % (len(self.images), len(self.shards), self.shard_dir))
+
+
+class ImageShards:
+    """
+    Reader of a directory written by ShardWriter. Shards are opened as read-only memmaps, so load_image()
+    returns an [H, W, 1] uint8 Y image without any decoding.
+    """
+
+    def __init__(self, shard_dir):
+
+        with open(shard_dir + "/" + SHARD_INDEX_FILE) as f:
+            index = json.load(f)
+
+        self.shard_dir = os.path.normpath(shard_dir)
+        self.channels = index["channels"]
+        self.shard_filenames = index["shards"]
+        self.shards = [None] * len(self.shard_filenames)
+        # images are named as files in shard_dir
+        self.filenames = [self.shard_dir + "/" + image[0] for image in index["images"]]
+        self.images = {filename: tuple(image[1:]) for filename, image in zip(self.filenames, index["images"])}
+
+    @staticmethod
+    def is_shard_dir(data_dir):
+        return os.path.isfile(data_dir + "/" + SHARD_INDEX_FILE)
+
+    def get_image_size(self, filename):
+        """ returns (width, height) like get_image_size(). """
+
+        shard_no, offset, height, width = self.images[os.path.normpath(filename)]
+        return width, height
+
+    def load_image(self, filename):
+
+        shard_no, offset, height, width = self.images[os.path.normpath(filename)]
+        if self.shards[shard_no] is None:
+            self.shards[shard_no] = np.load(self.shard_dir + "/" + self.shard_filenames[shard_no], mmap_mode="r")
+        return self.shards[shard_no][offset:offset + height * width].reshape(height, width, 1)
+
+
+class ImageCache:
+    """
+    LRU cache of decoded images bounded by total bytes.
+    With cache_dir, each decoded image is also saved as .npy and opened as memmap, so an image evicted from the
+    cache (or used in a later run) is not decoded again.
+    """
 
+    def __init__(self, max_bytes, cache_dir=""):
+
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.images = collections.OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+        # one lock per file, so threads missing the same file don't decode and write its cache file twice
+        self.file_locks = {}
+        self.hits = 0
+        self.misses = 0
+
+        if cache_dir != "":
+            util.make_dir(cache_dir)
+
+    def get(self, filename, load_function, suffix=""):
+        """ returns cached image of filename. load_function(filename) is called when it is not cached. """
+
+        with self.lock:
+            image = self.images.get(filename)
+            if image is not None:
+                self.images.move_to_end(filename)
+                self.hits += 1
+                return image
+            self.misses += 1
+
+        if self.cache_dir != "":
+            with self.lock:
+                file_lock = self.file_locks.setdefault(filename, threading.Lock())
+            with file_lock:
+                image = self.load_cache_file(filename, load_function, suffix)
+        else:
+            image = load_function(filename)
+
+        with self.lock:
+            if filename not in self.images and image.nbytes <= self.max_bytes:
+                self.images[filename] = image
+                self.bytes += image.nbytes
+                while self.bytes > self.max_bytes:
+                    _, evicted = self.images.popitem(last=False)
+                    self.bytes -= evicted.nbytes
         return image
+
+    def load_cache_file(self, filename, load_function, suffix):
+
+        # files of the same name in different directories must not share a cache file
+        path_hash = hashlib.sha1(os.path.abspath(filename).encode("utf-8")).hexdigest()[:12]
+        cache_filename = "%s/%s_%s%s.npy" % (self.cache_dir, os.path.basename(filename), path_hash, suffix)
+        if not os.path.isfile(cache_filename) or os.path.getmtime(cache_filename) < os.path.getmtime(filename):
+            save_npy_file(cache_filename, load_function(filename))
+        return np.load(cache_filename, mmap_mode="r")
+
+    def log_stats(self, reset=True):
+        if self.hits + self.misses > 0:
+            logging.info("Image cache: {} images, {:,} bytes, hits:{} misses:{} ({:.1f}% hit)".format(
+                len(self.images), self.bytes, self.hits, self.misses, 100.0 * self.hits / (self.hits + self.misses)))
+        if reset:
+            self.hits = 0
+            self.misses = 0
+
+
+class ImportanceSampler:
+    """
+    Samples patch numbers with probability proportional to their running (EMA) training loss, mixed with uniform
+    sampling by uniform_ratio so every patch is still visited. sample() also returns importance weights 1 / (N p)
+    which keep the weighted mean loss an unbiased estimate of the uniform mean loss.
+    Probabilities and their cumulative sum are refreshed every refresh_steps mini-batches.
+    """
+
+    def __init__(self, count, uniform_ratio=0.2, ema_decay=0.9, refresh_steps=50):
+
+        self.count = count
+        self.uniform_ratio = min(max(uniform_ratio, 1e-3), 1.0)
+        self.ema_decay = ema_decay
+        self.refresh_steps = refresh_steps
+
+        self.losses = np.zeros(count, dtype=np.float32)
+        self.seen = np.zeros(count, dtype=np.bool_)
+        self.probabilities = None
+        self.cdf = None
+        self.steps = 0
+
+    def reset(self):
+        """ forget running losses, ex. when the model is re-initialized for the next trial. """
+
+        self.losses.fill(0)
+        self.seen.fill(False)
+        self.probabilities = None
+        self.cdf = None
+        self.steps = 0
+
+    def update_cdf(self):
+
+        # unseen patches have mean loss of seen patches, so they are neither preferred nor starved
+        mean_loss = self.losses[self.seen].mean() if self.seen.any() else 1.0
+        losses = np.where(self.seen, self.losses, mean_loss)
+        loss_sum = losses.sum()
+        if loss_sum <= 0:
+            losses = np.ones(self.count, dtype=np.float32)
+            loss_sum = self.count
+
+        self.probabilities = (1.0 - self.uniform_ratio) * losses / loss_sum + self.uniform_ratio / self.count
+        self.cdf = np.cumsum(self.probabilities, dtype=np.float64)
+
+    def sample(self, batch_num):
+        """ returns (patch numbers, float32 importance weights) of a mini-batch. """
+
+        if self.cdf is None or self.steps % self.refresh_steps == 0:
+            self.update_cdf()
+        self.steps += 1
+
+        image_nos = np.searchsorted(self.cdf, np.random.random_sample(batch_num) * self.cdf[-1], side="right")
+        image_nos = np.minimum(image_nos, self.count - 1)
+        weights = 1.0 / (self.count * self.probabilities[image_nos])
+        return image_nos, weights.astype(np.float32)
+
+    def update(self, image_nos, losses):
+        """ update running loss of patches with their per-sample loss of the training step. """
+
+        first = ~self.seen[image_nos]
+        self.losses[image_nos] = np.where(first, losses,
+                                          self.ema_decay * self.losses[image_nos] + (1 - self.ema_decay) * losses)
+        self.seen[image_nos] = True
+
+    def log_stats(self):
+
+        if self.probabilities is None:
+            return
+        seen_losses = self.losses[self.seen]
+        logging.info("Importance sampling: %.1f%% patches seen, loss median %.6f / p99 %.6f, weight min %.3f max %.3f" % (
+            100.0 * seen_losses.shape[0] / self.count,
+            np.median(seen_losses) if seen_losses.shape[0] > 0 else 0,
+            np.percentile(seen_losses, 99) if seen_losses.shape[0] > 0 else 0,
+            1.0 / (self.count * self.probabilities.max()), 1.0 / (self.count * self.probabilities.min())))
+
+
+class BatchBuffers:
+    """
+    Ring of preallocated contiguous mini-batch arrays. Each entry has float32 input, interpolated and true batch
+    arrays and uint8 LR / HR work buffers for gathering patches.
+    """
+
+    def __init__(self, batch_num, input_size, true_size, count=2):
+
+        self.batch_num = batch_num
+        self.buffers = []
+        for _ in range(count):
+            self.buffers.append((np.zeros([batch_num, input_size, input_size, 1], dtype=np.float32),
+                                 np.zeros([batch_num, true_size, true_size, 1], dtype=np.float32),
+                                 np.zeros([batch_num, true_size, true_size, 1], dtype=np.float32),
+                                 np.zeros([batch_num, input_size, input_size, 1], dtype=np.uint8),
+                                 np.zeros([batch_num, true_size, true_size, 1], dtype=np.uint8)))
+        self.index = 0
+
+    def next(self):
+        buffers = self.buffers[self.index]
+        self.index = (self.index + 1) % len(self.buffers)
+        return buffers
+
+
+class BatchPrefetcher:
+    """
+    Builds next mini-batches (datasets.next_batch()) in a background thread while the current training step runs.
+    Most of the batch building time is spent in PIL / numpy which release GIL, so it overlaps with sess.run.
+    Starvation counters tell whether input (starved) or compute (producer blocked) is the bottleneck.
+    """
+
+    def __init__(self, datasets, batch_num, max_value, prefetch_batches=2):
+
+        self.datasets = datasets
+        self.batch_num = batch_num
+        self.max_value = max_value
+        self.queue = queue.Queue(maxsize=max(prefetch_batches, 1))
+        # queued batches + one being built + one used by training step
+        self.datasets.set_batch_buffer_count(max(prefetch_batches, 1) + 2)
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.error = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.batch_count = 0
+        self.starved_count = 0
+        self.starved_time = 0.0
+        self.blocked_count = 0
+
+    def start(self):
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.produce, name="BatchPrefetcher", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        # unblock the producer if it waits on a full queue
+        while self.thread is not None and self.thread.is_alive():
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                pass
+            self.thread.join(timeout=0.1)
+        self.thread = None
+
+    def produce(self):
+        try:
+            while not self.stop_event.is_set():
+                batch = self.datasets.next_batch(self.batch_num, self.max_value)
+                if self.queue.full():
+                    self.blocked_count += 1
+                while not self.stop_event.is_set():
+                    try:
+                        self.queue.put(batch, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+        except Exception as e:
+            self.error = e
+            self.queue.put(None)
+
+    def get(self):
+        try:
+            batch = self.queue.get_nowait()
+        except queue.Empty:
+            self.starved_count += 1
+            start_time = time.time()
+            batch = self.queue.get()
+            self.starved_time += time.time() - start_time
+
+        if batch is None:
+            raise self.error
+        self.batch_count += 1
+        return batch
+
+    def log_stats(self, reset=True):
+        if self.batch_count > 0:
+            logging.info("Prefetch: batches:{}, starved:{} ({:.1f}%), starved time:{:.2f}sec, producer blocked:{}".format(
+                self.batch_count, self.starved_count, 100.0 * self.starved_count / self.batch_count, self.starved_time,
+                self.blocked_count))
+        if reset:
+            self.reset_stats()
@@ -0,0 +1,177 @@
+"""
+Paper: "Fast and Accurate Image Super Resolution by Deep CNN with Skip Connection and Network in Network"
+Ver: 2
+
+numpy image resize engine
+
+Resizes [N, H, W, C] stacks of images at once with separable resize coefficients, which are computed the same way
+as PIL's Image.resize() and cached per (in_size, out_size, method).
+Small sizes (patches) are resized by two dense matrix multiplies, bigger images by a few weighted taps per axis.
+
+pil_compatible=True gives the same result as PIL per image:
+uint8 images use PIL's 22 bit fixed point coefficients, the horizontal pass is done first and rounded / clipped to
+uint8 before the vertical pass. float images are accumulated in float64 and stored as float32 like PIL "F" images.
+"""
+
+import functools
+import math
+
+import numpy as np
+
+RESAMPLING_METHODS = ["bicubic", "bilinear", "lanczos"]
+
+# same as PIL's PRECISION_BITS for 8bit images
+PRECISION_BITS = 32 - 8 - 2
+
+# sizes up to this use a dense [out, in] matrix, bigger ones use taps since dense matrix cost grows with in * out
+DENSE_MATRIX_MAX_SIZE = 256
+
+
+def get_resize_filter(resampling_method):
+    """ returns (filter function, support) of PIL's resampling filter. """
+
+    def bilinear(x):
+        x = abs(x)
+        return 1.0 - x if x < 1.0 else 0.0
+
+    def bicubic(x):
+        # a = -0.5 like PIL
+        a = -0.5
+        x = abs(x)
+        if x < 1.0:
+            return ((a + 2.0) * x - (a + 3.0)) * x * x + 1
+        if x < 2.0:
+            return (((x - 5) * x + 8) * x - 4) * a
+        return 0.0
+
+    def sinc(x):
+        if x == 0.0:
+            return 1.0
+        x *= math.pi
+        return math.sin(x) / x
+
+    def lanczos(x):
+        if -3.0 <= x < 3.0:
+            return sinc(x) * sinc(x / 3)
+        return 0.0
+
+    if resampling_method == "bicubic":
+        return bicubic, 2.0
+    elif resampling_method == "bilinear":
+        return bilinear, 1.0
+    elif resampling_method == "lanczos":
+        return lanczos, 3.0
+    raise ValueError("resize is not supported for [%s]" % resampling_method)
+
+
+@functools.lru_cache(maxsize=256)
+def get_resize_coefficients(in_size, out_size, resampling_method="bicubic", fixed_point=False):
+    """
+    returns (x_min [out_size] int array, weights [out_size, taps] float64 array) of a line resize like PIL:
+    out[x] = sum(weights[x, k] * in[x_min[x] + k]). fixed_point weights are PIL's integers scaled by 2^22.
+    cached arrays are read only.
+    """
+
+    resize_filter, support = get_resize_filter(resampling_method)
+    scale = in_size / out_size
+    filter_scale = max(scale, 1.0)
+    support *= filter_scale
+    ss = 1.0 / filter_scale
+
+    taps = int(math.ceil(support)) * 2 + 1
+    x_min = np.zeros([out_size], dtype=np.int64)
+    weights = np.zeros([out_size, taps], dtype=np.float64)
+
+    for xx in range(out_size):
+        center = (xx + 0.5) * scale
+        start = max(int(center - support + 0.5), 0)
+        end = min(int(center + support + 0.5), in_size)
+        line = [resize_filter((x - center + 0.5) * ss) for x in range(start, end)]
+        total = sum(line)
+        if total != 0.0:
+            line = [w / total for w in line]
+        # taps over the image edge have 0 weight, so x_min is moved back to keep all taps in the image
+        x_min[xx] = max(min(start, in_size - taps), 0)
+        weights[xx, start - x_min[xx]:end - x_min[xx]] = line
+
+    if fixed_point:
+        weights *= (1 << PRECISION_BITS)
+        weights = np.where(weights < 0, np.trunc(weights - 0.5), np.trunc(weights + 0.5))
+
+    x_min.setflags(write=False)
+    weights.setflags(write=False)
+    return x_min, weights
+
+
+@functools.lru_cache(maxsize=256)
+def get_resize_matrix(in_size, out_size, resampling_method="bicubic", fixed_point=False):
+    """ returns read only float64 [out_size, in_size] matrix M which resizes a line like PIL: out = M @ in. """
+
+    x_min, weights = get_resize_coefficients(in_size, out_size, resampling_method, fixed_point)
+    matrix = np.zeros([out_size, in_size], dtype=np.float64)
+    taps = min(weights.shape[1], in_size)
+    for k in range(taps):
+        matrix[np.arange(out_size), x_min + k] += weights[:, k]
+
+    matrix.setflags(write=False)
+    return matrix
+
+
+def resize_axis(images, out_size, axis, resampling_method, fixed_point):
+    """ resize float images along axis. result has the same dtype as images. """
+
+    in_size = images.shape[axis]
+    if in_size <= DENSE_MATRIX_MAX_SIZE:
+        matrix = get_resize_matrix(in_size, out_size, resampling_method, fixed_point).astype(images.dtype, copy=False)
+        return np.moveaxis(np.tensordot(images, matrix, axes=([axis], [1])), -1, axis)
+
+    x_min, weights = get_resize_coefficients(in_size, out_size, resampling_method, fixed_point)
+    shape = [1] * images.ndim
+    shape[axis] = out_size
+
+    result = None
+    for k in range(min(weights.shape[1], in_size)):
+        tap = np.take(images, x_min + k, axis=axis)
+        tap *= weights[:, k].astype(images.dtype).reshape(shape)
+        if result is None:
+            result = tap
+        else:
+            result += tap
+    return result
+
+
+def resize_images(images, out_height, out_width, resampling_method="bicubic", pil_compatible=True, out=None):
+    """
+    resize [N, H, W, C] uint8 or float images to [N, out_height, out_width, C].
+    returns uint8 for uint8 images and float32 for others. pil_compatible=False runs both passes in float32 and
+    rounds only the result, which is faster and differs from PIL by at most 1 for uint8 images.
+    """
+
+    integer = images.dtype == np.uint8
+    fixed_point = integer and pil_compatible
+    work_dtype = np.float64 if pil_compatible else np.float32
+
+    result = images
+    for axis, out_size in ((2, out_width), (1, out_height)):
+        if result.shape[axis] == out_size:
+            continue
+        result = resize_axis(result.astype(work_dtype, copy=False), out_size, axis, resampling_method, fixed_point)
+        if fixed_point:
+            # (sum + 2^21) >> 22 and clip to uint8 like PIL
+            result += (1 << (PRECISION_BITS - 1))
+            result *= 1.0 / (1 << PRECISION_BITS)
+            np.floor(result, out=result)
+            np.clip(result, 0, 255, out=result)
+        elif integer:
+            np.clip(result, 0, 255, out=result)
+        elif pil_compatible:
+            result = result.astype(np.float32).astype(work_dtype)
+
+    if integer and not fixed_point and result is not images:
+        result = np.clip(np.floor(result + 0.5), 0, 255)
+
+    dtype = np.uint8 if integer else np.float32
+    if out is not None:
+        np.copyto(out, result, casting="unsafe")
+        return out
+    return result.astype(dtype)
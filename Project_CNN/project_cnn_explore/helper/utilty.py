@@ -20,6 +20,8 @@ import cv2
 
 from skimage.measure import compare_psnr, compare_ssim
 
+from helper import color, resize
+
 
 class Timer:
     def __init__(self, timer_count=100):
@@ -138,58 +140,33 @@ def save_image_data(filename, image):
 
 
 def convert_rgb_to_y(image):
-    if len(image.shape) <= 2 or image.shape[2] == 1:
+    if len(image.shape) <= 2 or image.shape[-1] == 1:
         return image
 
-    xform = np.array([[65.738 / 256.0, 129.057 / 256.0, 25.064 / 256.0]])
-    y_image = image.dot(xform.T) + 16.0
-
-    return y_image
+    return color.rgb_to_y(image)
 
 
 def convert_rgb_to_ycbcr(image):
-    if len(image.shape) < 2 or image.shape[2] == 1:
+    if len(image.shape) < 3 or image.shape[-1] == 1:
         return image
 
-    xform = np.array(
-        [[65.738 / 256.0, 129.057 / 256.0, 25.064 / 256.0],
-         [- 37.945 / 256.0, - 74.494 / 256.0, 112.439 / 256.0],
-         [112.439 / 256.0, - 94.154 / 256.0, - 18.285 / 256.0]])
-
-    ycbcr_image = image.dot(xform.T)
-    ycbcr_image[:, :, 0] += 16.0
-    ycbcr_image[:, :, [1, 2]] += 128.0
-
-    return ycbcr_image
+    return color.rgb_to_ycbcr(image)
 
 
 def convert_ycbcr_to_rgb(ycbcr_image):
-    rgb_image = np.zeros([ycbcr_image.shape[0], ycbcr_image.shape[1], 3])  # type: np.ndarray
-
-    rgb_image[:, :, 0] = ycbcr_image[:, :, 0] - 16.0
-    rgb_image[:, :, [1, 2]] = ycbcr_image[:, :, [1, 2]] - 128.0
-    xform = np.array(
-        [[298.082 / 256.0, 0, 408.583 / 256.0],
-         [298.082 / 256.0, -100.291 / 256.0, -208.120 / 256.0],
-         [298.082 / 256.0, 516.412 / 256.0, 0]])
-    rgb_image = rgb_image.dot(xform.T)
-
-    return rgb_image
+    return color.ycbcr_to_rgb(ycbcr_image)
 
 
 def convert_y_and_cbcr_to_rgb(y_image, cbcr_image):
     if len(y_image.shape) <= 2:
-        y_image = y_image.reshape[y_image.shape[0], y_image.shape[1], 1]
+        y_image = y_image.reshape([y_image.shape[0], y_image.shape[1], 1])
 
     if len(y_image.shape) == 3 and y_image.shape[2] == 3:
         y_image = y_image[:, :, 0:1]
 
-    ycbcr_image = np.zeros([y_image.shape[0], y_image.shape[1], 3])
-    ycbcr_image[:, :, 0] = y_image[:, :, 0]
-    ycbcr_image[:, :, 1:3] = cbcr_image[:, :, 0:2]
+    return color.y_and_cbcr_to_rgb(y_image, cbcr_image)
+
 
-    return convert_ycbcr_to_rgb(ycbcr_image)
-    
 def compress_with_jpeg(true_image, compress_input_q, scale, resampling_method):
 
     # create LR RGB image
@@ -270,6 +247,42 @@ def resize_image_by_pil(image, scale, resampling_method="bicubic"):
     return image
 
 
+def resize_images(images, scale, resampling_method="bicubic", out=None):
+    """
+    resize [N, H, W, C] images by scale at once with the numpy resize engine (helper/resize.py).
+    result is the same as resize_image_by_pil() of each image. other methods than the engine supports use PIL.
+    """
+
+    new_height = int(images.shape[1] * scale)
+    new_width = int(images.shape[2] * scale)
+
+    if resampling_method in resize.RESAMPLING_METHODS:
+        return resize.resize_images(images, new_height, new_width, resampling_method=resampling_method, out=out)
+
+    if out is None:
+        out = np.empty([images.shape[0], new_height, new_width, images.shape[3]], dtype=images.dtype)
+    for i in range(images.shape[0]):
+        out[i] = resize_image_by_pil(images[i], scale, resampling_method=resampling_method)
+    return out
+
+
+def resize_batch_by_matrix(images, height_matrix, width_matrix):
+    """
+    resize [N, H, W, 1] float tensor of 0-255 pixel values with resize matrices (resize.get_resize_matrix()).
+    like PIL for 8bit images, horizontal pass is done first and both passes are rounded and clipped to 0-255.
+    """
+
+    def round_and_clip(image):
+        return tf.clip_by_value(tf.floor(image + 0.5), 0.0, 255.0)
+
+    images = tf.squeeze(images, axis=3)
+    # [N, H, W] x [W', W] -> [N, H, W']
+    images = round_and_clip(tf.tensordot(images, tf.constant(width_matrix, dtype=tf.float32), axes=[[2], [1]]))
+    # [N, H, W'] x [H', H] -> [N, W', H']
+    images = round_and_clip(tf.tensordot(images, tf.constant(height_matrix, dtype=tf.float32), axes=[[1], [1]]))
+    return tf.expand_dims(tf.transpose(images, [0, 2, 1]), axis=3)
+
+
 def load_image(filename, width=0, height=0, channels=0, alignment=0, print_console=True):
     if not os.path.isfile(filename):
         raise LoadError("File not found [%s]" % filename)
@@ -315,6 +328,9 @@ def load_image_data(filename, width=0, height=0, channels=0, alignment=0, print_
 
 
 def get_split_images(image, window_size, stride=None, enable_duplicate=False):
+    if len(image.shape) == 3 and image.shape[2] > 1:
+        return get_split_color_images(image, window_size, stride=stride)
+
     if len(image.shape) == 3 and image.shape[2] == 1:
         image = image.reshape(image.shape[0], image.shape[1])
 
@@ -358,6 +374,29 @@ def get_split_images(image, window_size, stride=None, enable_duplicate=False):
     return windows
 
 
+def get_split_color_images(image, window_size, stride=None):
+    """ split [H, W, C] image into [N, window_size, window_size, C] patches with a single strided view. """
+
+    image = np.ascontiguousarray(image)
+    window_size = int(window_size)
+    height, width, channels = image.shape
+    if stride is None:
+        stride = window_size
+    else:
+        stride = int(stride)
+
+    if height < window_size or width < window_size:
+        return None
+
+    new_height = 1 + (height - window_size) // stride
+    new_width = 1 + (width - window_size) // stride
+
+    shape = (new_height, new_width, window_size, window_size, channels)
+    strides = (image.strides[0] * stride, image.strides[1] * stride) + image.strides
+    windows = np.lib.stride_tricks.as_strided(image, shape=shape, strides=strides)
+    return windows.reshape(new_height * new_width, window_size, window_size, channels)
+
+
 # divide images with given stride. note return image size may not equal to window size.
 def get_divided_images(image, window_size, stride, min_size=0):
     h, w = image.shape[:2]
@@ -530,6 +569,9 @@ def get_loss_image(image1, image2, scale=1.0, border_size=0):
 
 
 def trim_image_as_file(image):
+    if image.dtype == np.uint8:
+        # already rounded and clipped
+        return image.astype(np.float32)
     image = np.rint(image)
     image = np.clip(image, 0, 255)
     if image.dtype != np.float32:
@@ -642,3 +684,24 @@ def flip(image, flip_type, invert=False):
             return np.flipud(np.rot90(image, -1))
         else:
             return np.rot90(np.flipud(image), 1)
+
+
+def flip_batch(images, flip_type):
+    """ same transform as flip() applied to each image of [N, H, W, C] batch. returns a view. """
+
+    if flip_type == 0:
+        return images
+    elif flip_type == 1:
+        return images[:, ::-1]
+    elif flip_type == 2:
+        return images[:, :, ::-1]
+    elif flip_type == 3:
+        return images[:, ::-1, ::-1]
+    elif flip_type == 4:
+        return np.rot90(images, 1, axes=(1, 2))
+    elif flip_type == 5:
+        return np.rot90(images, -1, axes=(1, 2))
+    elif flip_type == 6:
+        return np.rot90(images, 1, axes=(1, 2))[:, ::-1]
+    elif flip_type == 7:
+        return np.rot90(images, -1, axes=(1, 2))[:, ::-1]
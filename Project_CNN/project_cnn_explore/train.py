@@ -11,6 +11,7 @@ Testing Environment: Python 3.6.1, tensorflow >= 1.3.0
 import logging
 import sys
 import shutil
+import time
 import tensorflow as tf
 
 import DCSCN
@@ -131,6 +132,7 @@ def train(model, flags, trial):
         logging.info(" Training with compressed inputs: quality level={}".format(FLAGS.compress_input_q))
     psnr_best1 = ssim_best1 = epoch_best1_ssim = 0
     psnr_best2 = ssim_best2 = epoch_best2_psnr = 0
+    target_reached = False
     while model.lr > flags.end_lr:
 
         model.build_input_batch()
@@ -150,6 +152,12 @@ def train(model, flags, trial):
             psnr, ssim, psnr_rgb, ssim_rgb = model.evaluate(test_filenames)
             model.print_status(flags.test_dataset, psnr, ssim, psnr_rgb, ssim_rgb, log=True)
 
+            if flags.target_psnr > 0 and not target_reached and psnr >= flags.target_psnr:
+                target_reached = True
+                logging.info("*** Reached target PSNR {:.3f} @Epoch: {} Step: {} in {:.1f} sec (patch_filter: {})".format(
+                    flags.target_psnr, model.epochs_completed, model.step, time.time() - model.start_time,
+                    flags.patch_filter if flags.patch_filter else "none"))
+
             if FLAGS.eval_tests_while_train:
                 logging.info ("[Evaluation test results ...]")
                 for test_set in FLAGS.eval_tests_while_train:
@@ -206,6 +214,8 @@ def train(model, flags, trial):
             shutil.copy(FLAGS.log_filename, model.checkpoint_dir)
 
     model.end_train_step()
+    if flags.target_psnr > 0 and not target_reached:
+        logging.info("*** Target PSNR {:.3f} was not reached".format(flags.target_psnr))
 
     # save last generation anyway
     model.save_model(trial=trial, output_log=True, dir="final_epoch")